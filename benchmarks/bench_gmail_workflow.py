@@ -0,0 +1,119 @@
+'''
+End to end benchmark of the gmail workflow in google_api_cli.run against the
+simulated backend in fake_google, so no google account is needed. Reports wall
+time, api calls by method, bytes moved and peak RSS, optionally as json for CI
+to compare between commits.
+
+python benchmarks/bench_gmail_workflow.py --messages 500 --attachment_kb 256 \
+    --latency_ms 20 --error_rate 0.01 --workers 8 --json bench.json
+'''
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'google_api'))
+
+import google_api_cli as cli
+import google_api_core as gac
+from fake_google import FakeBackend
+
+parser = argparse.ArgumentParser(description='Benchmark the gmail workflow '   \
+                                             'against a simulated backend')
+parser.add_argument('--messages', type=int, default=200)
+parser.add_argument('--attachments_per_message', type=int, default=1)
+parser.add_argument('--attachment_kb', type=int, default=64)
+parser.add_argument('--sheet_rows', type=int, default=500)
+parser.add_argument('--unmatched_ratio', type=float, default=0.05)
+parser.add_argument('--latency_ms', type=float, default=0.0, help='latency '   \
+                    'added to every http round trip')
+parser.add_argument('--error_rate', type=float, default=0.0, help='chance '    \
+                    'each call fails with a 429')
+parser.add_argument('--pacing', action='store_true', help='pace requests to '  \
+                    'the real per user quotas, off by default so the backend ' \
+                    'latency is what gets measured')
+parser.add_argument('--backoff_ms', type=float, default=10.0, help='base '     \
+                    'retry backoff, kept short so injected 429s don\'t '       \
+                    'dominate wall time')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--json', help='write the report to this file')
+parser.add_argument('--keep', action='store_true', help='keep the temp dir '   \
+                    'with the downloaded attachments')
+# anything else is passed through to google_api_cli, ie --batch_size, --workers
+bench_args, cli_argv = parser.parse_known_args()
+
+def dir_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total
+
+def main():
+    backend = FakeBackend(messages=bench_args.messages,
+                          attachments_per_message=bench_args.attachments_per_message,
+                          attachment_bytes=bench_args.attachment_kb * 1024,
+                          sheet_rows=bench_args.sheet_rows,
+                          unmatched_ratio=bench_args.unmatched_ratio,
+                          latency=bench_args.latency_ms / 1000.0,
+                          error_rate=bench_args.error_rate,
+                          seed=bench_args.seed)
+    workdir = tempfile.mkdtemp(prefix='google_api_bench_')
+    out_dir = os.path.join(workdir, 'out') + os.sep
+    os.makedirs(out_dir)
+    # point everything the cli writes at the temp dir and swap the real
+    # services for the simulated ones
+    cli.basedir = workdir
+    cli.cachedir = os.path.join(workdir, '.cache')
+    cli.discovery_cachedir = os.path.join(cli.cachedir, 'discovery')
+    cli.history_checkpoint_f = os.path.join(workdir, 'history_checkpoints.json')
+    cli.journal_f = os.path.join(cli.cachedir, 'attachments_journal.sqlite3')
+    cli.manifest_index_f = os.path.join(cli.cachedir, 'manifest_index.sqlite3')
+    gac.authenticate = lambda service, **kwargs: backend.service(service)
+    gac.new_authorized_http = lambda build_obj: None
+    gac.SCHEDULER = gac.RequestScheduler(rates=None if bench_args.pacing else {},
+                                         base_delay=bench_args.backoff_ms / 1000.0)
+    args = cli.build_parser().parse_args(['gmail',
+                                  '-c', 'tradedata',
+                                  '-q', 'has:attachment',
+                                  '-s', 'bench_sheet',
+                                  '-r', 'Sheet1!A1:C{}'.format(bench_args.sheet_rows + 1),
+                                  '-o', out_dir,
+                                  '-a', os.path.join(workdir, 'attachments'),
+                                  '-m'] + cli_argv)
+    # cli metrics flags are normally applied in google_api_cli's __main__
+    gac.METRICS.enabled = bool(args.metrics or args.prom_file)
+    started = time.perf_counter()
+    cli.run(args)
+    wall = time.perf_counter() - started
+    backend_stats = backend.stats()
+    report = {'settings': vars(bench_args),
+              'cli_args': cli_argv,
+              'wall_seconds': round(wall, 4),
+              'api_calls': backend_stats['calls'],
+              'total_api_calls': backend_stats['total_calls'],
+              'errors_injected': backend_stats['errors_injected'],
+              'bytes_received': backend_stats['bytes_sent'],
+              'bytes_written': dir_size(os.path.join(workdir, 'attachments')),
+              'scheduler': gac.SCHEDULER.stats,
+              # ru_maxrss is in kilobytes on linux
+              'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)}
+    if gac.METRICS.enabled:
+        report['metrics'] = gac.METRICS.summary()
+    if args.prom_file:
+        gac.METRICS.write_prometheus(args.prom_file)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if bench_args.json:
+        with open(bench_args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if bench_args.keep:
+        print('Output kept in {}'.format(workdir))
+    else:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+'''
+Startup cost of the package and cli, each case run in a fresh interpreter so
+nothing is already imported. Reports the median wall time of every case over
+--runs runs and, with --modules, the slowest imports of each case from python's
+-X importtime output, optionally as json for CI to compare between commits.
+
+python benchmarks/bench_import_time.py --runs 20 --modules 5 --json startup.json
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+repo_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                        '..'))
+cli_f = os.path.join(repo_dir, 'google_api', 'google_api_cli.py')
+
+# name -> command run in a fresh interpreter
+CASES = {
+    'bare_interpreter': [sys.executable, '-c', 'pass'],
+    'import_package': [sys.executable, '-c', 'import google_api'],
+    'import_core': [sys.executable, '-c', 'import google_api.google_api_core'],
+    'import_cli': [sys.executable, '-c', 'import google_api.google_api_cli'],
+    'cli_help': [sys.executable, cli_f, '--help'],
+    'cli_gmail_help': [sys.executable, cli_f, 'gmail', '--help'],
+    # what every real run pays before its first request
+    'build_service_libs': [sys.executable, '-c', 'import google_api.google_api_core; '
+                                                 'import googleapiclient.discovery'],
+}
+
+parser = argparse.ArgumentParser(description='Benchmark package and cli '      \
+                                             'import time')
+parser.add_argument('--runs', type=int, default=10)
+parser.add_argument('--modules', type=int, default=0, help='show this many of '\
+                    'the slowest imports for each case')
+parser.add_argument('--json', help='write the report to this file')
+bench_args = parser.parse_args()
+
+def run_case(cmd):
+    started = time.perf_counter()
+    subprocess.run(cmd, cwd=repo_dir, check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+    return time.perf_counter() - started
+
+def slowest_imports(cmd, count):
+    # top level imports by cumulative microseconds from -X importtime
+    proc = subprocess.run(cmd[:1] + ['-X', 'importtime'] + cmd[1:], cwd=repo_dir,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # nested imports are indented under the module that pulled them in
+        if name.startswith('  ', 1):
+            continue
+        imports.append((name.strip(), int(cumulative_us) / 1000.0))
+    return sorted(imports, key=lambda i: -i[1])[:count]
+
+def main():
+    report = {'python': sys.version.split()[0], 'runs': bench_args.runs, 'cases': {}}
+    for name, cmd in CASES.items():
+        # one untimed run so the first case doesn't pay for a cold disk cache
+        run_case(cmd)
+        times = [run_case(cmd) for _ in range(bench_args.runs)]
+        case = {'median_ms': round(statistics.median(times) * 1000, 1),
+                'min_ms': round(min(times) * 1000, 1)}
+        if bench_args.modules:
+            case['slowest_imports_ms'] = slowest_imports(cmd, bench_args.modules)
+        report['cases'][name] = case
+        print('{:<20} {:>8.1f} ms median {:>8.1f} ms min'.format(name,
+                                                                case['median_ms'],
+                                                                case['min_ms']))
+        for module, ms in case.get('slowest_imports_ms', []):
+            print('    {:<40} {:>8.1f} ms'.format(module, ms))
+    if bench_args.json:
+        with open(bench_args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+'''
+Micro-benchmark for the sheets domain -> folder look up used by
+download_attachs and build_json. Times the old scan of every look up row
+against the index from build_look_up_index as the provider sheet grows.
+
+python benchmarks/bench_look_up_index.py
+'''
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'google_api'))
+
+import google_api_core as gac
+
+# sizes of the provider sheet to time, in rows
+SHEET_SIZES = [100, 1000, 5000, 20000]
+
+# number of attachments looked up per timing
+LOOKUPS = 1000
+
+def build_sheet(rows):
+    # synthetic look up file in the same shape query_sheets returns
+    return [['provider{}'.format(i), 'Folder{}'.format(i), str(i)]
+            for i in range(rows)]
+
+def linear_look_up(look_up_file, from_addr):
+    # the scan prepend_fldr_name and build_json used before the index
+    from_email_dom = from_addr.split('@')[-1].split('.')[0]
+    for item in look_up_file:
+        if from_email_dom in item:
+            return item
+    return None
+
+def main():
+    print('{:>8} {:>14} {:>14} {:>14}'.format('rows', 'linear us/op',
+                                              'index us/op', 'build ms'))
+    for rows in SHEET_SIZES:
+        sheet = build_sheet(rows)
+        rand = random.Random(rows)
+        from_addrs = ['Sender <trades@provider{}.com>'.format(rand.randrange(rows))
+                      for _ in range(LOOKUPS)]
+        build_secs = min(timeit.repeat(lambda: gac.build_look_up_index(sheet),
+                                       number=1, repeat=3))
+        look_up_index = gac.build_look_up_index(sheet)
+        linear_secs = min(timeit.repeat(lambda: [linear_look_up(sheet, a)
+                                                 for a in from_addrs],
+                                        number=1, repeat=3))
+        index_secs = min(timeit.repeat(lambda: [gac.find_look_up(look_up_index, a)
+                                                for a in from_addrs],
+                                       number=1, repeat=3))
+        print('{:>8} {:>14.2f} {:>14.2f} {:>14.2f}'.format(rows,
+                                                           linear_secs / LOOKUPS * 1e6,
+                                                           index_secs / LOOKUPS * 1e6,
+                                                           build_secs * 1e3))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+'''
+Simulated Gmail, Sheets and Drive backend for running the gmail workflow
+offline. Service objects mimic the googleapiclient resource chains the core
+module calls, ie service.users().messages().get(...), and serve a synthetic
+inbox built from the settings passed to FakeBackend. Every call can be given
+a fixed latency and a chance of failing with a 429, and the backend counts
+calls by api method and the bytes of every response. fields= masks and
+format=metadata are honored the way google applies them, so partial responses
+shrink the bytes counted. Messages added with add_messages after the inbox is
+built show up in history().list() from the historyId before them, and
+messages().list() honors labelIds and from: terms in q.
+'''
+import base64
+import collections
+import json
+import random
+import threading
+import time
+
+import httplib2
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
+
+# label the workflow adds to processed messages, has to exist in the inbox
+PROCESSED_LABEL = 'Automation_Processed'
+
+class FakeBackend(object):
+    # synthetic inbox of messages messages, each with attachments_per_message
+    # csv attachments of attachment_bytes bytes, from senders spread across
+    # the first sheet_rows providers in the sheets look up; unmatched_ratio of
+    # messages come from senders that aren't in the sheet. latency is seconds
+    # added to every http round trip and error_rate the chance a call gets a
+    # 429 rate limit error
+    def __init__(self, messages=100, attachments_per_message=1,
+                 attachment_bytes=64 * 1024, sheet_rows=100, unmatched_ratio=0.05,
+                 latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rand = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.bytes_sent = 0
+        self.errors_injected = 0
+        self.sheet_values = [['email_from_domain', 'folder_name', 'provider_id']]
+        self.sheet_values.extend(['provider{}'.format(i),
+                                  'Provider{}'.format(i),
+                                  str(1000 + i)] for i in range(sheet_rows))
+        self.sheet_rows = sheet_rows
+        self.unmatched_ratio = unmatched_ratio
+        self.attachments_per_message = attachments_per_message
+        self.attachment_bytes = attachment_bytes
+        self.messages = {}
+        self.attachments = {}
+        # historyId of the mailbox and the (historyId, message id) of every
+        # message added, in order
+        self.history_id = 1000
+        self.added = []
+        # every attachment shares one payload, only its size matters here
+        payload = base64.urlsafe_b64encode(bytes(bytearray(self.rand.getrandbits(8)
+                                                           for _ in range(attachment_bytes))))
+        self.attachment_data = payload.decode('UTF-8')
+        self.add_messages(messages)
+        self.labels = [{'id': 'INBOX', 'name': 'INBOX'},
+                       {'id': 'UNREAD', 'name': 'UNREAD'},
+                       {'id': 'Label_1', 'name': PROCESSED_LABEL}]
+
+    def add_messages(self, count, domain=None):
+        # add count messages to the inbox, from domain when passed otherwise
+        # spread across the providers like the initial inbox; returns the ids
+        added = []
+        for _ in range(count):
+            i = len(self.messages)
+            mess_id = '{:016x}'.format(i)
+            if domain is not None:
+                from_domain = domain
+            elif self.rand.random() < self.unmatched_ratio:
+                from_domain = 'unknown{}.com'.format(i)
+            else:
+                from_domain = 'provider{}.com'.format(self.rand.randrange(max(self.sheet_rows, 1)))
+            parts = [{'partId': '0',
+                      'filename': '',
+                      'mimeType': 'text/plain',
+                      'body': {'size': 12, 'data': 'aGVsbG8gd29ybGQ='}}]
+            for j in range(self.attachments_per_message):
+                attach_id = 'ANGjd{}x{}'.format(mess_id, j)
+                self.attachments[attach_id] = mess_id
+                parts.append({'partId': str(j + 1),
+                              'filename': 'trades_{}_{}.csv'.format(i, j),
+                              'mimeType': 'text/csv',
+                              'headers': [{'name': 'Content-Type',
+                                           'value': 'text/csv'}],
+                              'body': {'attachmentId': attach_id,
+                                       'size': self.attachment_bytes}})
+            self.messages[mess_id] = {
+                'id': mess_id,
+                'threadId': mess_id,
+                'labelIds': ['INBOX', 'UNREAD'],
+                'snippet': 'Daily trade file',
+                'payload': {'mimeType': 'multipart/mixed',
+                            'filename': '',
+                            'headers': [{'name': 'From',
+                                         'value': 'Trades <trades@{}>'.format(from_domain)},
+                                        {'name': 'To', 'value': 'me@example.com'},
+                                        {'name': 'Subject', 'value': 'Trades {}'.format(i)}],
+                            'parts': parts},
+                'sizeEstimate': self.attachment_bytes * self.attachments_per_message}
+            with self.lock:
+                self.history_id += 1
+                self.added.append((self.history_id, mess_id))
+            added.append(mess_id)
+        return added
+
+    def service(self, name):
+        return {'gmail': FakeGmail, 'sheets': FakeSheets, 'drive': FakeDrive}[name](self)
+
+    def round_trip(self):
+        # one http round trip, with the configured latency and error rate
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            failed = self.rand.random() < self.error_rate
+            if failed:
+                self.errors_injected += 1
+        if failed:
+            raise rate_limit_error()
+
+    def respond(self, method_id, response):
+        with self.lock:
+            self.calls[method_id] += 1
+            self.bytes_sent += len(json.dumps(response))
+        return response
+
+    def stats(self):
+        with self.lock:
+            return {'calls': dict(self.calls),
+                    'total_calls': sum(self.calls.values()),
+                    'bytes_sent': self.bytes_sent,
+                    'errors_injected': self.errors_injected}
+
+def rate_limit_error():
+    content = json.dumps({'error': {'code': 429,
+                                    'message': 'Rate Limit Exceeded',
+                                    'errors': [{'reason': 'rateLimitExceeded'}]}})
+    return HttpError(httplib2.Response({'status': 429}), content.encode('UTF-8'))
+
+def parse_fields(fields):
+    # fields= mask as a nested dict of field name to the mask for its
+    # subfields, an empty dict selecting the whole field, ie
+    # 'id,payload(headers,parts/filename)' ->
+    # {'id': {}, 'payload': {'headers': {}, 'parts': {'filename': {}}}}
+    def parse_list(i):
+        tree = {}
+        while i < len(fields) and fields[i] != ')':
+            i = parse_path(i, tree)
+            if i < len(fields) and fields[i] == ',':
+                i += 1
+        return tree, i
+    def parse_path(i, tree):
+        start = i
+        while i < len(fields) and fields[i] not in ',/()':
+            i += 1
+        node = tree.setdefault(fields[start:i].strip(), {})
+        if i < len(fields) and fields[i] == '/':
+            return parse_path(i + 1, node)
+        if i < len(fields) and fields[i] == '(':
+            sub, i = parse_list(i + 1)
+            node.update(sub)
+            return i + 1
+        return i
+    return parse_list(0)[0]
+
+def apply_fields(resource, mask):
+    # keep only the fields of resource selected by a parse_fields mask
+    if not mask:
+        return resource
+    if isinstance(resource, list):
+        return [apply_fields(item, mask) for item in resource]
+    if isinstance(resource, dict):
+        return {key: apply_fields(resource[key], sub)
+                for key, sub in mask.items() if key in resource}
+    return resource
+
+class FakeRequest(object):
+    # stands in for googleapiclient.http.HttpRequest
+    def __init__(self, backend, method_id, handler, fields=None):
+        self.backend = backend
+        self.methodId = method_id
+        self.handler = handler
+        self.fields = fields
+
+    def run(self):
+        response = self.handler()
+        if self.fields and self.fields != '*':
+            response = apply_fields(response, parse_fields(self.fields))
+        return self.backend.respond(self.methodId, response)
+
+    def execute(self, http=None, num_retries=0):
+        self.backend.round_trip()
+        return self.run()
+
+class FakeBatch(BatchHttpRequest):
+    # stands in for the batch request from new_batch_http_request(); one round
+    # trip for the batch, with each request in it able to fail on its own
+    def __init__(self, backend, callback=None):
+        self.backend = backend
+        self._callback = callback
+        self._requests = {}
+        self._callbacks = {}
+        self._order = []
+
+    def add(self, request, callback=None, request_id=None):
+        request_id = request_id or str(len(self._order))
+        self._requests[request_id] = request
+        self._callbacks[request_id] = callback
+        self._order.append(request_id)
+
+    def execute(self, http=None):
+        self.backend.round_trip()
+        self.backend.respond('batch', {})
+        for request_id in self._order:
+            request = self._requests[request_id]
+            callback = self._callbacks[request_id] or self._callback
+            with self.backend.lock:
+                failed = self.backend.rand.random() < self.backend.error_rate
+                if failed:
+                    self.backend.errors_injected += 1
+            if failed:
+                response, exception = None, rate_limit_error()
+            else:
+                try:
+                    response, exception = request.run(), None
+                except HttpError as exc:
+                    response, exception = None, exc
+            if callback is not None:
+                callback(request_id, response, exception)
+
+class FakeResource(object):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def request(self, method_id, handler, fields=None):
+        return FakeRequest(self.backend, method_id, handler, fields=fields)
+
+class FakeGmail(FakeResource):
+    def users(self):
+        return self
+
+    def messages(self):
+        return FakeMessages(self.backend)
+
+    def labels(self):
+        return FakeLabels(self.backend)
+
+    def history(self):
+        return FakeHistory(self.backend)
+
+    def getProfile(self, userId, fields=None):
+        return self.request('gmail.users.getProfile',
+                            lambda: {'emailAddress': 'me@example.com',
+                                     'messagesTotal': len(self.backend.messages),
+                                     'threadsTotal': len(self.backend.messages),
+                                     'historyId': str(self.backend.history_id)},
+                            fields=fields)
+
+    def watch(self, userId, body):
+        return self.request('gmail.users.watch',
+                            lambda: {'historyId': str(self.backend.history_id),
+                                     'expiration': '0'})
+
+    def stop(self, userId):
+        return self.request('gmail.users.stop', lambda: {})
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self.backend, callback=callback)
+
+class FakeMessages(FakeResource):
+    def list(self, userId, labelIds=None, q=None, maxResults=100, pageToken=None, fields=None, **kwargs):
+        def handler():
+            # from: terms in q match the sender's address, anything else in
+            # the query matches every message
+            from_terms = [term[len('from:'):] for term in (q or '').split()
+                          if term.startswith('from:')]
+            mess_ids = [mess_id for mess_id, mess in self.backend.messages.items()
+                        if all(l in mess['labelIds'] for l in labelIds or ())
+                        and all(term in mess['payload']['headers'][0]['value']
+                                for term in from_terms)]
+            start = int(pageToken or 0)
+            end = start + (maxResults or 100)
+            response = {'messages': [{'id': mess_id, 'threadId': mess_id}
+                                     for mess_id in mess_ids[start:end]],
+                        'resultSizeEstimate': len(mess_ids)}
+            if end < len(mess_ids):
+                response['nextPageToken'] = str(end)
+            return response
+        return self.request('gmail.users.messages.list', handler, fields=fields)
+
+    def get(self, userId, id, format='full', metadataHeaders=None, fields=None, **kwargs):
+        def handler():
+            if id not in self.backend.messages:
+                raise HttpError(httplib2.Response({'status': 404}), b'{}')
+            mess = self.backend.messages[id]
+            if format == 'metadata':
+                # headers only, narrowed to metadataHeaders when passed
+                headers = [h for h in mess['payload']['headers']
+                           if not metadataHeaders or h['name'] in metadataHeaders]
+                mess = dict(mess, payload={'mimeType': mess['payload']['mimeType'],
+                                           'headers': headers})
+            return mess
+        return self.request('gmail.users.messages.get', handler, fields=fields)
+
+    def attachments(self):
+        return FakeAttachments(self.backend)
+
+    def batchModify(self, userId, body):
+        def handler():
+            if len(body['ids']) > 1000:
+                raise HttpError(httplib2.Response({'status': 400}), b'{}')
+            for mess_id in body['ids']:
+                labels = self.backend.messages[mess_id]['labelIds']
+                labels[:] = [l for l in labels if l not in body.get('removeLabelIds', [])]
+                labels.extend(body.get('addLabelIds', []))
+            return {}
+        return self.request('gmail.users.messages.batchModify', handler)
+
+class FakeAttachments(FakeResource):
+    def get(self, userId, id, messageId, fields=None, **kwargs):
+        def handler():
+            data = self.backend.attachment_data
+            return {'attachmentId': id, 'size': len(data) * 3 // 4, 'data': data}
+        return self.request('gmail.users.messages.attachments.get', handler,
+                            fields=fields)
+
+class FakeLabels(FakeResource):
+    def list(self, userId, fields=None, **kwargs):
+        return self.request('gmail.users.labels.list',
+                            lambda: {'labels': self.backend.labels},
+                            fields=fields)
+
+    def create(self, userId, body, fields=None, **kwargs):
+        def handler():
+            label = {'id': 'Label_{}'.format(len(self.backend.labels)),
+                     'name': body['name']}
+            self.backend.labels.append(label)
+            return label
+        return self.request('gmail.users.labels.create', handler, fields=fields)
+
+class FakeHistory(FakeResource):
+    def list(self, userId, startHistoryId, fields=None, **kwargs):
+        # every message added after startHistoryId, in a single page
+        def handler():
+            history = [{'id': str(history_id),
+                        'messagesAdded': [{'message': {'id': mess_id,
+                                                       'threadId': mess_id}}]}
+                       for history_id, mess_id in self.backend.added
+                       if history_id > int(startHistoryId)]
+            response = {'historyId': str(self.backend.history_id)}
+            if history:
+                response['history'] = history
+            return response
+        return self.request('gmail.users.history.list', handler, fields=fields)
+
+class FakeSheets(FakeResource):
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def get(self, spreadsheetId, range=None, fields=None, **kwargs):
+        return self.request('sheets.spreadsheets.values.get',
+                            lambda: {'range': range,
+                                     'majorDimension': 'ROWS',
+                                     'values': self.backend.sheet_values},
+                            fields=fields)
+
+class FakeDrive(FakeResource):
+    def files(self):
+        return self
+
+    def get(self, fileId, fields=None, **kwargs):
+        return self.request('drive.files.get',
+                            lambda: {'kind': 'drive#file',
+                                     'id': fileId,
+                                     'name': 'look up',
+                                     'mimeType': 'application/vnd.google-apps.spreadsheet',
+                                     'version': '1',
+                                     'modifiedTime': '2019-03-19T00:00:00.000Z'},
+                            fields=fields)
@@ -0,0 +1,80 @@
+'''
+Stand in for Cloud Pub/Sub push delivery, so the gmail daemon's push endpoint
+can be exercised without a topic, subscription or public url. POSTs the same
+envelope a push subscription sends, a base64 json notification with the
+mailbox address and historyId in message.data, and prints the status the
+endpoint answered with; the daemon answers 204 and starts a pass.
+
+python google_api/google_api_cli.py gmail -c tradedata -q has:attachment \
+    --daemon --push_port 8085 --push_token secret
+python benchmarks/pubsub_push_stub.py --url http://127.0.0.1:8085/ \
+    --token secret --count 3 --interval 5
+'''
+import argparse
+import base64
+import datetime as dt
+import json
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+parser = argparse.ArgumentParser(description='Send pub/sub style gmail push '  \
+                                             'notifications to the daemon')
+parser.add_argument('--url', default='http://127.0.0.1:8085/')
+parser.add_argument('--token', help='push token the daemon was started with, '\
+                    'added to the url as ?token=')
+parser.add_argument('--email', default='me@example.com')
+parser.add_argument('--history_id', type=int, default=1000, help='historyId '  \
+                    'of the first notification, each one after is one higher')
+parser.add_argument('--count', type=int, default=1)
+parser.add_argument('--interval', type=float, default=1.0, help='seconds '     \
+                    'between notifications')
+parser.add_argument('--subscription', default='projects/local/subscriptions/'  \
+                                              'gmail-push')
+stub_args = parser.parse_args()
+
+def push_url(url, token=None):
+    if not token:
+        return url
+    parts = urllib.parse.urlparse(url)
+    query = urllib.parse.parse_qsl(parts.query) + [('token', token)]
+    return urllib.parse.urlunparse(parts._replace(query=urllib.parse.urlencode(query)))
+
+def build_envelope(email, history_id, message_id):
+    # what a push subscription POSTs for a gmail watch notification
+    notification = {'emailAddress': email, 'historyId': history_id}
+    data = base64.b64encode(json.dumps(notification).encode('UTF-8'))
+    return {'message': {'data': data.decode('UTF-8'),
+                        'messageId': str(message_id),
+                        'publishTime': dt.datetime.utcnow().isoformat() + 'Z'},
+            'subscription': stub_args.subscription}
+
+def send(url, envelope):
+    request = urllib.request.Request(url,
+                                     data=json.dumps(envelope).encode('UTF-8'),
+                                     headers={'Content-Type': 'application/json'},
+                                     method='POST')
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as exc:
+        return exc.code
+
+def main():
+    url = push_url(stub_args.url, stub_args.token)
+    statuses = []
+    for i in range(stub_args.count):
+        if i:
+            time.sleep(stub_args.interval)
+        envelope = build_envelope(stub_args.email, stub_args.history_id + i, i + 1)
+        status = send(url, envelope)
+        statuses.append(status)
+        print('historyId {} -> {}'.format(stub_args.history_id + i, status))
+    # pub/sub treats anything but 102, 200, 201, 202 and 204 as a failure
+    if any(status not in (102, 200, 201, 202, 204) for status in statuses):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
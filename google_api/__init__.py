@@ -1,2 +1,30 @@
-from .google_api_cli import *
-from .google_api_core import *
+# the core and cli modules are imported the first time one of their names is
+# used rather than with the package, so importing google_api doesn't pay for
+# the google client libraries until they're needed
+import importlib
+import sys
+
+# python 3.6 ignores a module __getattr__, so the names below would just be
+# missing; fail with the real reason instead
+if sys.version_info < (3, 7):
+    raise ImportError('google_api requires Python 3.7 or newer, this is '     \
+                      '{}.{}'.format(*sys.version_info[:2]))
+
+SUBMODULES = ('google_api_core', 'google_api_cli')
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    # from google_api import * exports every public name of both modules, as
+    # the star imports this replaced did
+    if name == '__all__':
+        return [n for submodule in SUBMODULES
+                for n in dir(__getattr__(submodule)) if not n.startswith('_')]
+    for submodule in SUBMODULES:
+        module = __getattr__(submodule)
+        if hasattr(module, name):
+            return getattr(module, name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(__getattr__('__all__')))
@@ -9,64 +9,285 @@ the argparse
 Notes: User should note this app uses OAuth 2.0 and requires user approval via
        we browser the first time the app runs based on credentials downloaded
        from google api console; after approval a pickle file is created in
-       local directort for future uses without the need for browser approval;
-       it's suggested that user run script locally with credentials than save
-       pickle in remote directory to run
+       the tokens directory, named after the --credentials account, for future
+       uses without the need for browser approval; it's suggested that user
+       run script locally with credentials than save pickle in remote
+       directory to run
 
-python google_api.py calendar -c personal
+python google_api_cli.py calendar -c personal --start 2019-03-19 --days 7
+python google_api_cli.py gmail --accounts accounts.json -o out/
 '''
 import argparse
+import base64
+import concurrent.futures
 import datetime as dt
+import itertools
+import json
 import os
+import signal
+import threading
+import time
+import urllib.parse
 
-import google_api_core as gac
+# imported relatively when loaded as part of the google_api package, directly
+# when the script is run on its own
+if __package__:
+    from . import google_api_core as gac
+else:
+    import google_api_core as gac
 
 ################################################################################
 # ############################ SET CLI ARGS ################################## #
 ################################################################################
-parser = argparse.ArgumentParser(description='CLI wrapper for google services' \
-                                             ' api')
+# the parser is built when it's needed rather than at import, each google
+# service is its own subcommand with only the options that apply to it, ie
+# python google_api_cli.py gmail -c tradedata -q has:attachment
+def build_parser():
+    parser = argparse.ArgumentParser(description='CLI wrapper for google '     \
+                                     'services api')
 
-# required arg to determine which service is being used, expceted in first
-# position after filename
-parser.add_argument('service', help='specify the google service to connect to,'\
-                                    ' [drive, gmail]')
+    # options shared by every service
+    common = argparse.ArgumentParser(add_help=False)
 
-# query to send service, only applicable for certain services, in this case
-# used as a gmail query against an inbox
-parser.add_argument('-q', '--query', type=str, help='Pass query to service')
+    # output directory to drop anything being returned by api
+    common.add_argument('-o', '--out', help='Path of desired output directory')
 
-# name of resource to search for, in this case name of google sheets resource
-parser.add_argument('-n', '--name', type=str, help='Pass name of resource to ' \
-                                                'service')
+    # filename for credentials downloaded from google api console, see notes
+    # above
+    common.add_argument('-c', '--credentials', help='specify credentials file '\
+                        'to use')
 
-# output directory to drop anything being returned by api
-parser.add_argument('-o', '--out', help='Path of desired output directory')
+    # client secrets file for accounts other than the known ones in
+    # CREDENTIALS_FILES
+    common.add_argument('--credentials_file', help='client secrets file for '  \
+                        'the --credentials account, defaults to '              \
+                        '<account>_credentials.json in the base directory')
 
-# filename for credentials downloaded from google api console, see notes above
-parser.add_argument('-c', '--credentials', help='specify credentials file to ' \
-                                            'use')
+    # build services only from cached discovery documents, no discovery
+    # requests
+    common.add_argument('--offline-discovery', dest='offline_discovery',
+                        action='store_true', help='only use cached discovery ' \
+                        'documents to build services, fails if one isn\'t '    \
+                        'cached')
 
-# date to add to query, ie days minus today that should be included in range
-parser.add_argument('-d',
-                    '--query_date',
-                    type=int,
-                    help='days from current date to include in query. e.g. '   \
-                    'if looking for all mail from yesterday, pass 1; if 2 days'\
-                    'back pass 2, etc.')
+    # instrumentation of every api call and pipeline stage
+    common.add_argument('--metrics', action='store_true', help='record '       \
+                        'latency, count, bytes and retries per api method and '\
+                        'stage in the run\'s json report')
+    common.add_argument('--prom_file', help='write run metrics to this file '  \
+                        'in prometheus textfile format, implies --metrics')
+    common.add_argument('--profile', help='dump cProfile stats for the run to '\
+                        'this file, implies --metrics')
 
-# sheet id for sheets api, can be pulled from URL while sheet is open in browser
-parser.add_argument('-s', '--sheet_id', help='sheet ID to query')
+    # ask for whole resources instead of the partial responses in FIELD_MASKS
+    common.add_argument('--full_responses', action='store_true',
+                        help='request full api responses rather than only the '\
+                        'fields used, to compare bytes per call or debug a '   \
+                        'missing field')
 
-# ranges to pass to sheet api; format is Sheet1!A1:F100
-parser.add_argument('-r','--ranges', help='ranges to query on sheet')
+    # required arg to determine which service is being used, expceted in first
+    # position after filename
+    services = parser.add_subparsers(dest='service', metavar='service',
+                                     help='google service to connect to')
+    services.required = True
 
-# directory to drop attachments pulled from gmail api
-parser.add_argument('-a', '--attach_dir', help='specify dir for attachments '  \
-                          'to download to, otherwise, uses parent dir of file')
-# boolean to make directories if output doesn't exist or to raise exception
-parser.add_argument('-m', '--mkdir', action='store_true', help='create output '\
-                    'dir and parents if it doesn\'t already exist or raise exception')
+    ############################## DRIVE ######################################
+    drive = services.add_parser('drive', parents=[common], help='download '    \
+                                'files from drive')
+
+    # name of resource to search for, in this case name of google sheets
+    # resource
+    drive.add_argument('-n', '--name', type=str, help='Pass name of resource ' \
+                       'to service')
+
+    # drive folder to download files from, with or without a name
+    drive.add_argument('-f', '--folder_id', help='drive folder ID to download '\
+                       'files from, pass without a name to download the folder')
+
+    # mime type of drive files to download, ie application/pdf
+    drive.add_argument('-t', '--mime_type', help='only download drive files '  \
+                       'of this mime type')
+
+    # number of threads to download files with, each thread gets its own http
+    # transport; 0 downloads files one at a time
+    drive.add_argument('-w', '--workers', type=int, default=0, help='number '  \
+                       'of worker threads to download files with, defaults to '\
+                       'downloading one at a time')
+
+    ############################## GMAIL ######################################
+    gmail = services.add_parser('gmail', parents=[common], help='pull '        \
+                                'attachments from the inbox into the folders ' \
+                                'in the sheets look up')
+
+    # query to send service, only applicable for certain services, in this
+    # case used as a gmail query against an inbox
+    gmail.add_argument('-q', '--query', type=str, help='Pass query to service')
+
+    # date to add to query, ie days minus today that should be included in
+    # range
+    gmail.add_argument('-d',
+                       '--query_date',
+                       type=int,
+                       help='days from current date to include in query. e.g. '\
+                       'if looking for all mail from yesterday, pass 1; if 2 ' \
+                       'days back pass 2, etc.')
+
+    # sheet id for sheets api, can be pulled from URL while sheet is open in
+    # browser
+    gmail.add_argument('-s', '--sheet_id', help='sheet ID of the look up')
+
+    # ranges to pass to sheet api; format is Sheet1!A1:F100
+    gmail.add_argument('-r','--ranges', help='ranges of the look up on sheet')
+
+    # account the sheets look up is read with, separate from the gmail account
+    gmail.add_argument('--sheets_credentials', default='personal',
+                       help='account used to read the sheets look up')
+
+    # directory to drop attachments pulled from gmail api
+    gmail.add_argument('-a', '--attach_dir', help='specify dir for '           \
+                       'attachments to download to, otherwise, uses parent '   \
+                       'dir of file')
+    # boolean to make directories if output doesn't exist or to raise exception
+    gmail.add_argument('-m', '--mkdir', action='store_true', help='create '    \
+                       'output dir and parents if it doesn\'t already exist '  \
+                       'or raise exception')
+    # number of message gets to group into each gmail batch http request, 0
+    # falls back to fetching messages one at a time
+    gmail.add_argument('-b', '--batch_size', type=int, default=50,
+                       help='number of messages to fetch per gmail batch '     \
+                       'request, max 100; pass 0 to fetch messages one at a '  \
+                       'time')
+    # number of threads to download attachments with, each thread gets its own
+    # http transport; 0 downloads attachments one at a time
+    gmail.add_argument('-w', '--workers', type=int, default=0, help='number '  \
+                       'of worker threads to download attachments with, '      \
+                       'defaults to downloading one at a time')
+    # sqlite journal of stored attachments, used to skip what a crashed run
+    # already downloaded and to hardlink duplicate files instead of writing them
+    # again
+    gmail.add_argument('-j', '--journal', nargs='?', const=True, help='keep a '\
+                       'journal of stored attachments so reruns skip them and '\
+                       'duplicates are hardlinked, optionally at this path')
+    # match subdomains of senders against parent domains in the sheets look up
+    gmail.add_argument('-u', '--suffix_match', action='store_true',
+                       help='match sender subdomains, ie mail.acme.com, '      \
+                       'against parent domains in the sheets look up')
+    # only pull mail added since the last successful run, using gmail history
+    gmail.add_argument('-i', '--incremental', action='store_true', help='only '\
+                       'pull messages added to the inbox since the last '      \
+                       'successful incremental run that still match the '      \
+                       'query; falls back to the date query on the first '     \
+                       'run or if the checkpoint has expired')
+    # expand zip attachments into their provider folder as they're downloaded
+    gmail.add_argument('--expand_zips', action='store_true', help='expand '    \
+                       'members of zip attachments with accepted extensions '  \
+                       'into the attachment\'s folder as they download')
+    gmail.add_argument('--remove_zips', action='store_true', help='delete zip '\
+                       'attachments once fully expanded, with --expand_zips')
+    # jsonl manifest of every attachment handled, indexed across runs
+    gmail.add_argument('--no_manifest', action='store_true', help='don\'t '    \
+                       'write a manifest of the run or add it to the index')
+    gmail.add_argument('--manifest_index', help='sqlite index of every run\'s '\
+                       'manifest, defaults to manifest_index.sqlite3 in the '  \
+                       'cache dir')
+    # cap on the number of messages pulled from the inbox per run
+    gmail.add_argument('-x', '--max_results', type=int, help='maximum number ' \
+                       'of messages to pull from the inbox, defaults to all '  \
+                       'matches')
+    # run as a long lived worker instead of once
+    gmail.add_argument('--daemon', action='store_true', help='keep running '   \
+                       'and process new mail every poll interval or on push '  \
+                       'notification, implies --incremental')
+    gmail.add_argument('--poll_interval', type=int, default=300,
+                       help='seconds between gmail runs in daemon mode')
+    # local endpoint for gmail push notifications from a pub/sub push
+    # subscription
+    gmail.add_argument('--push_port', type=int, help='port to accept gmail '   \
+                       'push notifications on in daemon mode')
+    gmail.add_argument('--push_host', default='127.0.0.1', help='address to '  \
+                       'bind the push notification endpoint to')
+    gmail.add_argument('--push_token', help='token push requests must carry '  \
+                       'as a token query parameter')
+    # pub/sub topic gmail should publish inbox changes to, ie
+    # projects/my-project/topics/gmail
+    gmail.add_argument('--watch_topic', help='pub/sub topic to register a '    \
+                       'gmail watch on in daemon mode')
+    # run the gmail workflow for every account in a json config, in parallel
+    gmail.add_argument('--accounts', help='json config listing accounts with ' \
+                       'their own queries, sheets and output dirs to process ' \
+                       'in parallel')
+    # processes used for --accounts, defaults to one per account
+    gmail.add_argument('--processes', type=int, help='maximum accounts '       \
+                       'processed at once with --accounts')
+
+    ############################## SHEETS #####################################
+    sheets = services.add_parser('sheets', parents=[common], help='save the '  \
+                                 'values of a sheet range as json')
+
+    # sheet id for sheets api, can be pulled from URL while sheet is open in
+    # browser
+    sheets.add_argument('-s', '--sheet_id', required=True, help='sheet ID to ' \
+                        'query')
+
+    # ranges to pass to sheet api; format is Sheet1!A1:F100
+    sheets.add_argument('-r','--ranges', required=True, help='ranges to query '\
+                        'on sheet')
+
+    ############################## CALENDAR ###################################
+    calendar = services.add_parser('calendar', parents=[common], help='query ' \
+                                   'calendar events from a locally synced '    \
+                                   'store')
+
+    # calendar to query, primary is the account's own calendar
+    calendar.add_argument('--cal_id', default='primary', help='calendar ID to '\
+                          'query, defaults to primary')
+
+    # words every returned event has to contain in its summary, description or
+    # location
+    calendar.add_argument('-q', '--query', help='only return events matching ' \
+                          'every word of the query')
+
+    # range of events to return, without a query defaults to the next day
+    calendar.add_argument('--start', help='start of the range of events to '   \
+                          'return as an iso date or datetime, ie 2019-03-19 '  \
+                          'or 2019-03-19T09:00, defaults to now')
+    calendar.add_argument('--days', type=int, help='days from start to return '\
+                          'events for, defaults to 1 unless only a query is '  \
+                          'passed')
+
+    # local mirror of the calendar, only changes are fetched once it's synced
+    calendar.add_argument('--store', help='sqlite file events are synced to, ' \
+                          'defaults to calendar.sqlite3 in the cache dir')
+    calendar.add_argument('--sync_max_age', type=int,
+                          default=gac.CALENDAR_SYNC_MAX_AGE, help='seconds '   \
+                          'since the last sync before the store is synced '    \
+                          'again, 0 always syncs')
+    calendar.add_argument('--no_sync', action='store_true', help='answer from '\
+                          'the store without syncing it')
+
+    ############################## MANIFEST ###################################
+    # queries the local index of gmail run manifests, no google service used
+    manifest = services.add_parser('manifest', help='look up which runs '      \
+                                   'handled a message, domain, folder or date')
+    manifest.add_argument('--message_id', help='gmail message ID')
+    manifest.add_argument('--domain', help='sender domain, subdomains match '  \
+                          'too')
+    manifest.add_argument('--folder', help='folder name from the sheets look ' \
+                          'up')
+    manifest.add_argument('--date', help='day the attachment was handled, as ' \
+                          'YYYY-MM-DD')
+    manifest.add_argument('--run_id', help='run ID from the manifest')
+    manifest.add_argument('--runs', action='store_true', help='list runs '     \
+                          'instead of attachments')
+    manifest.add_argument('--limit', type=int, default=100, help='most '       \
+                          'records to return, newest first, 0 for all')
+    manifest.add_argument('--index', help='manifest index to query, defaults ' \
+                          'to manifest_index.sqlite3 in the cache dir')
+    manifest.add_argument('--json', action='store_true', help='print matches ' \
+                          'as json')
+    manifest.set_defaults(metrics=False, prom_file=None, profile=None)
+
+    return parser
 
 ################################################################################
 # ############################ SET VARIABLES ################################# #
@@ -76,6 +297,22 @@ parser.add_argument('-m', '--mkdir', action='store_true', help='create output '\
 # can use os.getcwd() if __file__ not available
 basedir = os.path.abspath(os.path.join(__file__,'../..'))
 
+# local cache for data pulled from google that rarely changes between runs
+cachedir = os.path.join(basedir, '.cache')
+
+# discovery documents used to build service objects, saved so each run doesn't
+# have to fetch them again
+discovery_cachedir = os.path.join(cachedir, 'discovery')
+
+# default calendar store, used when --store isn't passed
+calendar_store_f = os.path.join(cachedir, 'calendar.sqlite3')
+
+# default index of every gmail run's manifest
+manifest_index_f = os.path.join(cachedir, 'manifest_index.sqlite3')
+
+# default attachment journal, used when --journal is passed without a path
+journal_f = os.path.join(cachedir, 'attachments_journal.sqlite3')
+
 # default dump directory for attachments, if not passed in CLI
 attachdir = basedir+'\\attachments\\'
 
@@ -87,6 +324,20 @@ personal_credentials_f = os.path.abspath(os.path.join(basedir,'drive_sheets_'  \
 tradedata_credentials_f = os.path.abspath(os.path.join(basedir,'client_secret_'\
                                                               'c2b_gmail.json'))
 
+# client secrets files for the accounts used so far, any other account reads
+# <account>_credentials.json from the base directory unless a file is passed
+CREDENTIALS_FILES = {
+    'tradedata': tradedata_credentials_f,
+    'personal': personal_credentials_f,
+}
+
+# mailbox historyIds saved after each successful incremental gmail run, keyed
+# by credentials name and query
+history_checkpoint_f = os.path.join(basedir, 'history_checkpoints.json')
+
+# seconds between renewals of the gmail watch request in daemon mode
+WATCH_RENEW_SECONDS = 24 * 60 * 60
+
 # a list of scopes for app to execute against, complete list found at:
 # https://developers.google.com/gmail/api/auth/scopes
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly',
@@ -108,16 +359,606 @@ up_to_date_service_versions = {
     'calendar': 'v3',
 }
 
+################################################################################
+# ############################ GMAIL WORKFLOW ################################ #
+################################################################################
+# pull attachments from the inbox, drop them in the folder for their sender
+# from the sheets look up, and label the messages processed
+def run_gmail(args, service):
+    # query date sets the range to today that should be searched againt the
+    # inbox, ie value of 4 = search for all emails from 4 days ago to today
+    if args.query_date:
+        query_date = args.query_date
+    else:
+        # default query date is 1, can probably set this in argparse
+        query_date = 1
+    # workflow for sheets api call, read with the --sheets_credentials
+    # account. the look up table is loaded once per run and served from the
+    # local cache unless the sheet has been edited
+    sheets_data = []
+    look_up = {}
+    if args.sheet_id:
+        sheets_credentials_f = credentials_path(args.sheets_credentials)
+        sheets_service = gac.authenticate(scopes=SCOPES,
+                                          basedir=basedir,
+                                          credentials_f=sheets_credentials_f,
+                                          service='sheets',
+                                          serv_vers=up_to_date_service_versions['sheets'],
+                                          cache_dir=discovery_cachedir,
+                                          offline=args.offline_discovery,
+                                          account=args.sheets_credentials)
+        drive_service = gac.authenticate(scopes=SCOPES,
+                                         basedir=basedir,
+                                         credentials_f=sheets_credentials_f,
+                                         service='drive',
+                                         serv_vers=up_to_date_service_versions['drive'],
+                                         cache_dir=discovery_cachedir,
+                                         offline=args.offline_discovery,
+                                         account=args.sheets_credentials)
+        sheets_cache_f = os.path.join(cachedir,
+                                      'sheets',
+                                      '{}.json'.format(args.sheet_id))
+        with gac.METRICS.stage('sheets_lookup') as stage:
+            sheets_data = gac.load_sheets_look_up(sheets_service,
+                                                  drive_service,
+                                                  sheet_id=args.sheet_id,
+                                                  ranges=args.ranges,
+                                                  cache_f=sheets_cache_f,
+                                                  look_up=look_up)
+            # stage bytes are only worked out when metrics are on
+            if gac.METRICS.enabled:
+                stage.add_bytes(gac.response_size(sheets_data))
+    # set start of query as today minus query date passed in CLI
+    start_date = dt.datetime.now() - dt.timedelta(days=query_date)
+    # format date in gmail query approriately, see URL for more options:
+    # https://support.google.com/mail/answer/7190?hl=en
+    search_query = args.query + ' after:{}'.format(start_date.strftime('%Y/%m/%d'))
+    # message ids are streamed from the inbox, one page at a time, as the
+    # attachment lookup below consumes them; incremental runs only pull
+    # messages added since the last successful run's history checkpoint
+    if args.incremental:
+        checkpoint_key = '{}:{}'.format(args.credentials, args.query)
+        checkpoint = gac.load_history_checkpoint(history_checkpoint_f,
+                                                 checkpoint_key)
+        # taken before listing so mail arriving mid run is picked up by
+        # the next run rather than skipped
+        current_history_id = gac.get_mailbox_history_id(service)
+        checkpoint_time = time.time()
+        # messages with no folder are only looked up again once the sheet
+        # has been edited, until then they're carried over unchecked
+        sheet_revision = look_up.get('revision')
+        retry_no_folder = sheet_revision != checkpoint['sheet_revision']
+        carried_no_folder = [] if retry_no_folder else checkpoint['no_folder']
+        retry_ids = list(checkpoint['pending'])
+        if retry_no_folder:
+            retry_ids.extend(checkpoint['no_folder'])
+        listing = {}
+        mess_ids = gac.pull_mail_since_checkpoint(service,
+                                                  checkpoint['history_id'],
+                                                  search_query,
+                                                  max_results=args.max_results,
+                                                  pending=retry_ids,
+                                                  listing=listing,
+                                                  since=checkpoint['saved_at'])
+    else:
+        mess_ids = gac.pull_mail_from_query(service,
+                                            search_query,
+                                            max_results=args.max_results)
+    # peek at the first id so an empty inbox or query with no matches is
+    # still reported; json file is still created with query passed in CLI,
+    # except in daemon mode where most passes find nothing new and it's only
+    # logged, rather than leaving a report in the output dir every pass
+    first_id = next(mess_ids, None)
+    if first_id is None:
+        if args.daemon:
+            print('No new messages that match query: {}'.format(search_query))
+        else:
+            gac.build_json(args.out, error_mess='No messages that match '     \
+                                                'query: {}'.format(search_query),
+                           account=args.credentials)
+        if args.incremental:
+            gac.save_history_checkpoint(history_checkpoint_f,
+                                        checkpoint_key,
+                                        current_history_id,
+                                        no_folder=carried_no_folder,
+                                        sheet_revision=sheet_revision,
+                                        saved_at=checkpoint_time)
+        return {'account': args.credentials,
+                'attachments': 0,
+                'downloaded': 0,
+                'failed': 0,
+                'not_accepted': 0,
+                'expanded': 0,
+                'not_found': 0,
+                'labeled': 0,
+                'failed_label_chunks': 0}
+    mess_ids = itertools.chain([first_id], mess_ids)
+    # details_tup contains, attach id, mess id, from addr, filename in that
+    # order; not accepted contains any messages that had file extensions
+    # not in the accepted extensions list
+    with gac.METRICS.stage('message_fetch'):
+        if args.batch_size:
+            file_details_tup, not_accepted, fetch_stats = gac.batch_pull_attachs_from_query_results(build_obj=service,
+                                                                                                    mess_ids=mess_ids,
+                                                                                                    batch_size=args.batch_size)
+            # unbatched path makes 2 gets per message, one for the parts and
+            # one for the from addr
+            unbatched_trips = 2 * fetch_stats['messages']
+            print('Fetched {} messages in {} batch requests, saved {} round '  \
+                  'trips'.format(fetch_stats['messages'],
+                                 fetch_stats['round_trips'],
+                                 unbatched_trips - fetch_stats['round_trips']))
+        else:
+            file_details_tup, not_accepted = gac.pull_attachs_from_query_results(build_obj=service,
+                                                                                 mess_ids=mess_ids)
+    # index the sheet once by domain, used to find the folder for every
+    # attachment in download_attachs and build_json
+    look_up_index = gac.build_look_up_index(sheets_data)
+    # attachments land in the dir passed in CLI, otherwise the default
+    attach_dir = args.attach_dir or attachdir
+    # attach dict contains filename prepended with foldername as key, with
+    # attachment resource minus its data as values; failed holds any
+    # attachments that couldn't be downloaded, keyed the same way with message
+    # id and error
+    # the journal lets a rerun skip attachments a crashed run already stored
+    journal = None
+    if args.journal:
+        journal = gac.AttachmentJournal(journal_f if args.journal is True      \
+                                        else args.journal)
+    # every attachment handled is appended to the run's manifest as it's
+    # written, and indexed so later runs can look up what handled a message
+    manifest = None
+    if not args.no_manifest:
+        run_date = dt.datetime.now().strftime('%Y%m%d_%H%M%S')
+        manifest_f = os.path.join(args.out or '',
+                                  '{}_{}_c2b_trade_date_email_manifest.jsonl'.format(run_date,
+                                                                                    args.credentials))
+        manifest = gac.RunManifest(manifest_f,
+                                   index=gac.ManifestIndex(args.manifest_index or manifest_index_f),
+                                   account=args.credentials,
+                                   query=search_query)
+        for a_id in not_accepted:
+            manifest.record_attachment(a_id, 'not_accepted')
+    status = 'failed'
+    labeled = 0
+    try:
+        with gac.METRICS.stage('attachment_download') as stage:
+            attach_dict, failed = gac.download_attachs(build_obj=service,
+                                                       attach_ids_list=file_details_tup,
+                                                       attachdir=attach_dir,
+                                                       look_up_file=look_up_index,
+                                                       mkdir=args.mkdir,
+                                                       workers=args.workers,
+                                                       suffix_match=args.suffix_match,
+                                                       journal=journal,
+                                                       manifest=manifest,
+                                                       expand_zips=args.expand_zips,
+                                                       remove_zips=args.remove_zips)
+            # decoded size of the attachments pulled down, those the journal
+            # skipped weren't
+            stage.add_bytes(sum(v.get('size', 0) for v in attach_dict.values()))
+        # not found messages is passed to batch_modify function to ensure
+        # that any messages that did not have corresponding folder name are
+        # not marked as read and pushed out of inbox
+        report = {}
+        with gac.METRICS.stage('build_json') as stage:
+            not_found_mess_ids = gac.build_json(output_dir=args.out,
+                                                not_accepted_tup=not_accepted,
+                                                file_details=file_details_tup,
+                                                look_up_file=look_up_index,
+                                                suffix_match=args.suffix_match,
+                                                account=args.credentials,
+                                                report=report)
+            stage.add_bytes(os.path.getsize(report['path']))
+        no_folder_mess_ids = list(not_found_mess_ids)
+        # messages with a failed download stay in the inbox for the next run
+        failed_mess_ids = {v['message_id'] for v in failed.values()}
+        not_found_mess_ids.extend(failed_mess_ids - set(not_found_mess_ids))
+        # update labels on emails to passed label, removing inbox as a label
+        # and marking the emails as read; the label id is cached per account
+        # and the label is created if it's missing
+        label_cache_f = os.path.join(cachedir,
+                                     'labels',
+                                     '{}.json'.format(args.credentials))
+        with gac.METRICS.stage('labeling'):
+            label_report = gac.batch_modify_message_label(build_obj=service,
+                                                          attach_ids_list=file_details_tup,
+                                                          not_found_lst=not_found_mess_ids,
+                                                          label='Automation_Processed',
+                                                          label_cache_f=label_cache_f)
+        labeled = label_report['labeled']
+        print('Labeled {} messages, {} chunks failed'.format(label_report['labeled'],
+                                                             len(label_report['failed_chunks'])))
+        # the report was written before labeling, bring its metrics up to
+        # date now every stage has run
+        gac.finish_json_report(report['path'])
+        status = 'ok' if not failed and not label_report['failed_chunks'] else 'partial'
+    finally:
+        if journal is not None:
+            journal.close()
+        if manifest is not None:
+            manifest.close(status=status, labeled=labeled)
+            manifest.index.close()
+    # run finished, next incremental run starts from here. messages left in
+    # the inbox with a failed download or label are kept as pending, checked
+    # again by the next run, and those with no folder are kept until the
+    # sheet changes. if max_results cut the listing short the checkpoint
+    # stays where it was, so the messages not listed this run are still in
+    # the history the next run reads, and anything left over is kept
+    if args.incremental:
+        pending = list(failed_mess_ids)
+        for failed_chunk in label_report['failed_chunks']:
+            pending.extend(failed_chunk['ids'])
+        no_folder_mess_ids = [mess_id for mess_id in no_folder_mess_ids
+                              if mess_id not in set(pending)]
+        if not listing['truncated']:
+            gac.save_history_checkpoint(history_checkpoint_f,
+                                        checkpoint_key,
+                                        current_history_id,
+                                        pending=pending,
+                                        no_folder=carried_no_folder + no_folder_mess_ids,
+                                        sheet_revision=sheet_revision,
+                                        saved_at=checkpoint_time)
+        elif checkpoint['history_id']:
+            gac.save_history_checkpoint(history_checkpoint_f,
+                                        checkpoint_key,
+                                        checkpoint['history_id'],
+                                        pending=checkpoint['pending'] + pending,
+                                        no_folder=checkpoint['no_folder'] + no_folder_mess_ids,
+                                        sheet_revision=checkpoint['sheet_revision'],
+                                        saved_at=checkpoint['saved_at'])
+    # counts for the run, combined across accounts by run_accounts
+    return {'account': args.credentials,
+            'attachments': len(file_details_tup),
+            'downloaded': len(attach_dict),
+            'failed': len(failed),
+            'not_accepted': len(not_accepted),
+            'expanded': sum(len(v.get('expanded', [])) for v in attach_dict.values()),
+            'not_found': len(not_found_mess_ids),
+            'labeled': label_report['labeled'],
+            'failed_label_chunks': len(label_report['failed_chunks'])}
+
+################################################################################
+# ############################ SHEETS WORKFLOW ############################### #
+################################################################################
+# save the values of a sheet range as json in the output dir, or print them
+# when there isn't one
+def run_sheets(args, service):
+    values = gac.query_sheets_values(service, args.sheet_id, args.ranges)
+    if not args.out:
+        print(json.dumps(values, indent=2))
+        return values
+    out_f = os.path.join(args.out, '{}_sheet_values.json'.format(args.sheet_id))
+    gac.write_json_atomic(out_f, {'sheet_id': args.sheet_id,
+                                  'ranges': args.ranges,
+                                  'values': values})
+    print('{} rows saved to {}'.format(len(values), out_f))
+    return values
+
+################################################################################
+# ############################ CALENDAR WORKFLOW ############################# #
+################################################################################
+# events in a date range and/or matching a text query, answered from the local
+# calendar store after syncing any changes since the last run into it
+def run_calendar(args, service):
+    store = gac.CalendarStore(args.store or calendar_store_f)
+    try:
+        if not args.no_sync:
+            stats = gac.sync_calendar_if_stale(service,
+                                               args.cal_id,
+                                               store,
+                                               max_age=args.sync_max_age)
+            if stats:
+                full = ' (full sync)' if stats['full_sync'] else ''
+                print('Synced calendar {calendar}: {updated} events updated, ' \
+                      '{deleted} deleted{full}'.format(full=full, **stats))
+        # a query on its own searches every event, otherwise the range runs
+        # from start, default now, for days, default 1
+        time_min = time_max = None
+        if not args.query or args.start or args.days:
+            if args.start:
+                time_min = dt.datetime.fromisoformat(args.start)
+            else:
+                time_min = dt.datetime.now()
+            time_max = time_min + dt.timedelta(days=args.days or 1)
+        # synced above, so the lookups below never go to the api
+        if args.query:
+            events = gac.get_cal_events_by_query(service,
+                                                 args.cal_id,
+                                                 args.query,
+                                                 store=store,
+                                                 sync_max_age=None,
+                                                 time_min=time_min,
+                                                 time_max=time_max)
+        else:
+            events = gac.get_cal_events_by_date_range(service,
+                                                      args.cal_id,
+                                                      time_min,
+                                                      time_max,
+                                                      store=store,
+                                                      sync_max_age=None)
+    finally:
+        store.close()
+    if args.out:
+        out_f = os.path.join(args.out, '{}_calendar_events.json'.format(
+                             dt.datetime.now().strftime('%Y%m%d_%H%M%S')))
+        gac.write_json_atomic(out_f, {'calendar_id': args.cal_id,
+                                      'query': args.query,
+                                      'time_min': time_min and time_min.isoformat(),
+                                      'time_max': time_max and time_max.isoformat(),
+                                      'events': events})
+        print('{} events saved to {}'.format(len(events), out_f))
+    else:
+        for event in events:
+            start = event.get('start', {})
+            print('{:<25} {}'.format(start.get('dateTime', start.get('date', '')),
+                                     event.get('summary', '(no title)')))
+    return events
+
+################################################################################
+# ############################ MANIFEST QUERIES ############################## #
+################################################################################
+# attachments, or runs, from the index of every gmail run's manifest
+def run_manifest_query(args):
+    index_f = args.index or manifest_index_f
+    if not os.path.exists(index_f):
+        print('No manifest index at {}'.format(index_f))
+        return []
+    index = gac.ManifestIndex(index_f)
+    try:
+        if args.runs:
+            matches = index.runs(limit=args.limit)
+        else:
+            matches = index.query(message_id=args.message_id,
+                                  domain=args.domain,
+                                  folder=args.folder,
+                                  date=args.date,
+                                  run_id=args.run_id,
+                                  limit=args.limit)
+    finally:
+        index.close()
+    if args.json:
+        print(json.dumps(matches, indent=2))
+    elif args.runs:
+        for run in matches:
+            print('{run_id}  {started}  {status}  {counts}  '                  \
+                  '{manifest_f}'.format(**run))
+    else:
+        for match in matches:
+            print('{recorded_at}  {run_id}  {status:<12} {message_id}  '       \
+                  '{from_domain}  {folder_name}/{filename}'.format(**match))
+    return matches
+
+################################################################################
+# ############################ DAEMON MODE ################################### #
+################################################################################
+# handles gmail push notifications forwarded by a pub/sub push subscription,
+# or anything standing in for one, by waking the daemon loop
+# built on first use, so http.server is only imported by daemons serving a
+# push endpoint
+def push_notification_handler():
+    import http.server
+    class PushNotificationHandler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            # when a token is set the push endpoint url must carry it, ie
+            # http://host:port/?token=secret
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            if self.server.push_token and                                      \
+               query.get('token', [''])[0] != self.server.push_token:
+                self.send_response(403)
+                self.end_headers()
+                return
+            # pub/sub wraps the notification as base64 json in message.data,
+            # with the mailbox address and its latest historyId
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                envelope = json.loads(self.rfile.read(length).decode('UTF-8'))
+                notification = json.loads(base64.b64decode(envelope['message']['data']))
+            except (ValueError, KeyError, TypeError):
+                self.send_response(400)
+                self.end_headers()
+                return
+            print('Push notification for {} at history {}'.format(
+                  notification.get('emailAddress'), notification.get('historyId')))
+            self.server.wake.set()
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            # requests are already reported in do_POST
+            return None
+    return PushNotificationHandler
+
+def start_push_server(host, port, wake, push_token=None):
+    # serve the push endpoint from a background thread, setting wake on every
+    # valid notification
+    import http.server
+    server = http.server.ThreadingHTTPServer((host, port),
+                                             push_notification_handler())
+    server.wake = wake
+    server.push_token = push_token
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print('Listening for push notifications on {}:{}'.format(host, port))
+    return server
+
+def run_daemon(args, service):
+    # keep the gmail, sheets and drive services and credentials warm and run
+    # the gmail workflow every poll interval, or as soon as a push
+    # notification arrives; each pass is incremental, so only new mail is
+    # processed. SIGTERM or SIGINT finishes the current pass then exits
+    args.incremental = True
+    stop = threading.Event()
+    wake = threading.Event()
+    def shutdown(signum, frame):
+        print('Received signal {}, shutting down after current run'.format(signum))
+        stop.set()
+        wake.set()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    server = None
+    if args.push_port:
+        server = start_push_server(args.push_host,
+                                   args.push_port,
+                                   wake,
+                                   push_token=args.push_token)
+    # gmail watch requests expire after 7 days, renew well before then
+    watch_renewed = 0
+    cred_manager = gac.get_credential_manager(os.path.join(basedir, 'tokens'))
+    try:
+        while not stop.is_set():
+            # clear before the run so a push arriving mid run triggers another
+            wake.clear()
+            try:
+                if args.watch_topic and                                        \
+                   time.time() - watch_renewed > WATCH_RENEW_SECONDS:
+                    gac.watch_mailbox(service, args.watch_topic)
+                    watch_renewed = time.time()
+                cred_manager.refresh_expiring()
+                run_gmail(args, service)
+            except Exception as exc:
+                # one bad pass shouldn't take the daemon down, the next pass
+                # picks up from the last saved checkpoint
+                print('Gmail run failed: {!r}'.format(exc))
+            wake.wait(timeout=args.poll_interval)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        if args.watch_topic and watch_renewed:
+            gac.stop_mailbox_watch(service)
+    return None
+
+################################################################################
+# ############################ MULTI ACCOUNT ################################# #
+################################################################################
+# counts in each account's run summary that are added up across accounts
+SUMMARY_TOTALS = ['attachments', 'downloaded', 'failed', 'not_accepted',
+                  'expanded', 'not_found', 'labeled', 'failed_label_chunks']
+
+def load_accounts_config(args):
+    # one args namespace per account in the --accounts config, ie
+    # {"defaults": {"query": "has:attachment", "sheet_id": "...",
+    #               "ranges": "Sheet1!A1:C500"},
+    #  "accounts": [{"credentials": "tradedata", "out": "out/tradedata/",
+    #                "attach_dir": "attachments/tradedata"},
+    #               {"credentials": "ops", "credentials_file": "ops.json",
+    #                "query": "from:ops has:attachment"}]}
+    # keys are the cli option names; each account starts from the options
+    # passed in CLI, then the config defaults, then its own settings
+    with open(args.accounts) as f:
+        config = json.load(f)
+    base = dict(vars(args), accounts=None)
+    accounts_args = []
+    for account in config['accounts']:
+        settings = dict(base)
+        for source in (config.get('defaults', {}), account):
+            for key, value in source.items():
+                if key not in base or key in ('service', 'accounts'):
+                    raise ValueError('Unknown setting {} in accounts config '  \
+                                     '{}'.format(key, args.accounts))
+                settings[key] = value
+        if not settings['credentials'] or not settings['query']:
+            raise ValueError('Every account in {} needs credentials and a '    \
+                             'query'.format(args.accounts))
+        accounts_args.append(argparse.Namespace(**settings))
+    names = [a.credentials for a in accounts_args]
+    if len(set(names)) != len(names):
+        raise ValueError('Accounts listed more than once in {}'.format(args.accounts))
+    return accounts_args
+
+def run_account(args):
+    # gmail workflow for one account, run in a worker process so each account
+    # has its own credentials, services, http connections and quota
+    # scheduler; errors are reported in the summary rather than raised so one
+    # bad account doesn't stop the others
+    gac.METRICS.enabled = bool(args.metrics or args.prom_file or args.profile)
+    started = time.time()
+    try:
+        summary = run(args)
+        summary['status'] = 'ok'
+    except Exception as exc:
+        summary = {'account': args.credentials,
+                   'status': 'error',
+                   'error': repr(exc)}
+    summary['wall_seconds'] = round(time.time() - started, 3)
+    summary['scheduler'] = dict(gac.SCHEDULER.stats)
+    if gac.METRICS.enabled:
+        summary['metrics'] = gac.METRICS.summary()
+    return summary
+
+def run_accounts(args):
+    # run every account in the --accounts config in parallel processes, so the
+    # whole run takes about as long as the slowest mailbox, and write one
+    # summary combining them to the output dir
+    if args.service != 'gmail' or args.daemon:
+        raise ValueError('--accounts only runs the gmail workflow, without '   \
+                         '--daemon')
+    accounts_args = load_accounts_config(args)
+    processes = args.processes or len(accounts_args)
+    started = time.time()
+    summaries = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [pool.submit(run_account, a) for a in accounts_args]
+        for account_args, future in zip(accounts_args, futures):
+            try:
+                summaries.append(future.result())
+            except Exception as exc:
+                # the worker process itself died, ie killed or out of memory
+                summaries.append({'account': account_args.credentials,
+                                  'status': 'error',
+                                  'error': repr(exc)})
+    combined = {'create_date': dt.datetime.now().strftime('%Y%m%d_%H%M%S'),
+                'wall_seconds': round(time.time() - started, 3),
+                'processes': processes,
+                'accounts': summaries,
+                'totals': {k: sum(s.get(k, 0) for s in summaries)
+                           for k in SUMMARY_TOTALS},
+                'errors': [s['account'] for s in summaries if s['status'] != 'ok']}
+    # a worker that died never timed its account
+    combined['slowest_account_seconds'] = max(s.get('wall_seconds', 0) for s in summaries)
+    for s in summaries:
+        if s['status'] == 'ok':
+            print('{account}: {downloaded} of {attachments} attachments '      \
+                  'downloaded, {labeled} labeled in '                          \
+                  '{wall_seconds:.1f}s'.format(**s))
+        else:
+            print('{account}: failed with {error}'.format(**s))
+    print('{} accounts in {:.1f}s, slowest {:.1f}s'.format(len(summaries),
+                                                        combined['wall_seconds'],
+                                                        combined['slowest_account_seconds']))
+    if args.out:
+        gac.write_json_atomic(os.path.join(args.out,
+                                           '{}_accounts_summary.json'.format(combined['create_date'])),
+                              combined)
+    return combined
+
 ################################################################################
 # ############################ MAIN FUNCTION ################################# #
 ################################################################################
+def credentials_path(account, credentials_f=None):
+    # client secrets file for account, the one passed if any, then the known
+    # accounts, then <account>_credentials.json in the base directory
+    if credentials_f:
+        return os.path.abspath(credentials_f)
+    if account in CREDENTIALS_FILES:
+        return CREDENTIALS_FILES[account]
+    return os.path.abspath(os.path.join(basedir,
+                                        '{}_credentials.json'.format(account)))
+
 def run(args):
+    # manifest queries are answered locally, no credentials needed
+    if args.service == 'manifest':
+        return run_manifest_query(args)
+    # partial responses unless full ones were asked for, set here so worker
+    # processes for --accounts pick it up too
+    gac.FIELD_MASKS_ENABLED = not args.full_responses
+    # every account in the config is run in its own process
+    if args.service == 'gmail' and args.accounts:
+        return run_accounts(args)
     # set path for credentials using specific filename based on credentials arg
     # passed in CLI; app should only be using pickle files in prod
-    if args.credentials == 'tradedata':
-        credentials_f = tradedata_credentials_f
-    elif args.credentials == 'personal':
-        credentials_f = personal_credentials_f
+    credentials_f = credentials_path(args.credentials, args.credentials_file)
     # grab current version from dict above
     serv_vers = up_to_date_service_versions[args.service]
     # returns service object used for specific api methods
@@ -125,85 +966,56 @@ def run(args):
                                basedir=basedir,
                                credentials_f=credentials_f,
                                service = args.service,
-                               serv_vers=serv_vers)
-    # currently only 1 workflow for drive service
+                               serv_vers=serv_vers,
+                               cache_dir=discovery_cachedir,
+                               offline=args.offline_discovery,
+                               account=args.credentials)
+    # currently only 1 workflow for drive service, download every file that
+    # matches the name, folder and mime type passed in CLI
     if args.service == 'drive':
-        gac.download_files_from_drive(service, args.name, out_dir=args.out)
+        gac.download_files_from_drive(service,
+                                      fname=args.name,
+                                      out_dir=args.out or '',
+                                      folder_id=args.folder_id,
+                                      mime_type=args.mime_type,
+                                      workers=args.workers)
     # workflow for gmail api to pull down attachments, a portion of this
-    # workflow uses the sheets api which currently hardcoded to use personal
-    # credentials while the gmail service uses tradedata credentials
+    # workflow uses the sheets api with the --sheets_credentials account
+    # while the gmail service uses the --credentials account
     elif args.service == 'gmail':
-        # query date sets the range to today that should be searched againt the
-        # inbox, ie value of 4 = search for all emails from 4 days ago to today
-        if args.query_date:
-            query_date = args.query_date
+        if args.daemon:
+            run_daemon(args, service)
         else:
-            # default query date is 1, can probably set this in argparse
-            query_date = 1
-        # workflow for sheets api call, as mentioned above; this workflow is
-        # currently hardcoded
-        if args.sheet_id:
-            sheets_service = gac.authenticate(scopes=SCOPES,
-                                              basedir=basedir,
-                                              credentials_f=personal_credentials_f,
-                                              service='sheets',
-                                              serv_vers='v4')
-            look_up_details = gac.query_sheets(sheets_service,
-                                               sheet_id = args.sheet_id,
-                                               ranges = args.ranges)
-        # set start of query as today minus query date passed in CLI
-        start_date = dt.datetime.now() - dt.timedelta(days=query_date)
-        # format date in gmail query approriately, see URL for more options:
-        # https://support.google.com/mail/answer/7190?hl=en
-        search_query = args.query + ' after:{}'.format(start_date.strftime('%Y/%m/%d'))
-        # results of search query returned as a dict if there were no issues
-        results = gac.pull_mail_from_query(service, search_query)
-        # results returns as string if there was an issue, ie the inbox was
-        # empty or or there were no attachments within the specific date range
-        # json file is still created with query passed in CLI
-        if type(results) == str:
-            gac.build_json(args.out, error_mess=results)
-            return None
-        # details_tup contains, attach id, mess id, from addr, filename in that
-        # order; not accepted contains any messages that had file extensions
-        # not in the accepted extensions list
-        file_details_tup, not_accepted = gac.pull_attachs_from_query_results(build_obj=service,
-                                                                             results=results)
-        # sheets data is values in cells in range in sheet passed to CLI
-        sheets_data = gac.query_sheets(build_obj=sheets_service,
-                                       sheet_id=args.sheet_id,
-                                       ranges=args.ranges)
-        # attach_dict contains filename as key and base64 encoded data as value
-        if args.attach_dir:
-            attachdir = args.attach_dir
-        # attach dict contains filename prepended with foldername as key, with
-        # values as attach_id, message_id, foldername, providerid
-        attach_dict = gac.download_attachs(build_obj=service,
-                                           attach_ids_list=file_details_tup,
-                                           attachdir=attachdir,
-                                           look_up_file=sheets_data,
-                                           mkdir=args.mkdir)
-        # not found messages is passed to batch_modify function to ensure
-        # that any messages that did not have corresponding folder name are not
-        # marked as read and pushed out of inbox
-        not_found_mess_ids = gac.build_json(output_dir=args.out,
-                                            not_accepted_tup=not_accepted,
-                                            file_details=file_details_tup,
-                                            look_up_file=sheets_data,)
-        # update labels on emails to passed label, removing inbox as a label
-        # and marking the emails as read, the
-        gac.batch_modify_message_label(build_obj=service,
-                                       attach_ids_list=file_details_tup,
-                                       not_found_lst=not_found_mess_ids,
-                                       label='Automation_Processed',)
+            return run_gmail(args, service)
+    elif args.service == 'sheets':
+        return run_sheets(args, service)
     elif args.service == 'calendar':
-        if args.datetime:
-            dt_search = datetime.datetime(args.datetime)
-        else:
-            dt_search = datetime.datetime.now()
-
+        return run_calendar(args, service)
     return None
 
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    # per call and per stage metrics, off unless asked for
+    gac.METRICS.enabled = bool(args.metrics or args.prom_file or args.profile)
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        result = run(args)
+    finally:
+        if args.profile:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if args.prom_file:
+            gac.METRICS.write_prometheus(args.prom_file)
+    # report time lost to quota pacing and rate limit backoff during the run
+    if gac.SCHEDULER.stats['requests']:
+        print('{requests} requests, {retries} retries, '                       \
+              '{quota_wait_seconds:.1f}s waiting on quota, '                   \
+              '{backoff_seconds:.1f}s backing off from rate '                  \
+              'limits'.format(**gac.SCHEDULER.stats))
+    return result
+
 if __name__ == '__main__':
-    args = parser.parse_args()
-    run(args)
+    main()
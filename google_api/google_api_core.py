@@ -7,178 +7,1097 @@ The core module houses the main functions for the api and interacts
 with the cli module for proper functionality
 '''
 import base64
+import concurrent.futures
+import contextlib
 import datetime as dt
 import errno
+import hashlib
+import itertools
 import json
 import os
 import pickle
+import random
+import socket
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
 
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+# datetime.fromisoformat and http.server.ThreadingHTTPServer are 3.7+
+if sys.version_info < (3, 7):
+    raise ImportError('google_api requires Python 3.7 or newer, this is '     \
+                      '{}.{}'.format(*sys.version_info[:2]))
+
+# the google client libraries take a few hundred ms to import, only the error
+# and discovery cache base classes are needed up front, the rest are imported
+# in the functions that use them so a run only loads what its service needs
+from googleapiclient.discovery_cache import base as discovery_cache_base
+from googleapiclient.errors import HttpError
 
 EXTENSIONS = ['txt', 'csv', 'xlsx', 'xls', '', 'dat', 'zip', 'rpg', 'acf']
 
+# seconds a cached discovery document is used before it's refetched online
+DISCOVERY_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
+# seconds before a token expires that it's refreshed
+TOKEN_REFRESH_MARGIN = 5 * 60
+
+# google native drive files can't be downloaded directly, they're exported as
+# the mime type and file extension here
+DRIVE_NATIVE_PREFIX = 'application/vnd.google-apps.'
+DRIVE_EXPORT_TYPES = {
+    'application/vnd.google-apps.spreadsheet': ('text/csv', '.csv'),
+    'application/vnd.google-apps.document':
+        ('application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+         '.docx'),
+    'application/vnd.google-apps.presentation': ('application/pdf', '.pdf'),
+    'application/vnd.google-apps.drawing': ('image/png', '.png'),
+}
+
+# bytes requested per chunk when streaming drive files to disk
+DRIVE_CHUNK_SIZE = 10 * 1024 * 1024
+
+# largest page files().list() will return in one call
+DRIVE_LIST_PAGE_SIZE = 1000
+
+# gmail accepts up to 100 calls in a single batch request, but recommends
+# keeping batches at 50 or fewer to avoid rate limiting
+GMAIL_MAX_BATCH_SIZE = 100
+
+# number of base64 chars decoded and written per chunk when saving attachments
+B64_DECODE_CHUNK_SIZE = 1024 * 1024
+
+# most message ids a single batchModify call accepts
+GMAIL_MAX_MODIFY_IDS = 1000
+
+# largest page messages().list() will return in one call
+GMAIL_MAX_LIST_PAGE_SIZE = 500
+
+# seconds before a history checkpoint that incremental runs still list mail
+# from when matching new mail against the query, so mail whose receipt time
+# is a little older than the history entry adding it isn't dropped
+HISTORY_QUERY_SLACK = 60 * 60
+
+# largest page events().list() will return in one call
+CALENDAR_LIST_PAGE_SIZE = 2500
+
+# seconds a synced calendar store answers queries before it's synced again
+CALENDAR_SYNC_MAX_AGE = 5 * 60
+
+# manifest records written between each fsync and index update
+MANIFEST_CHECKPOINT_EVERY = 50
+
+# bytes copied at a time when expanding zip attachment members to disk
+ZIP_COPY_CHUNK_SIZE = 1024 * 1024
+
+# ############################################################################ #
+# ########################### PARTIAL RESPONSES ############################## #
+# ############################################################################ #
+# fields= masks for every call the workflows make, each listing only the
+# fields its workflow reads from the response so google doesn't send, and the
+# client doesn't parse, anything else. a workflow reading a new field has to
+# add it here. syntax and savings are described at:
+# https://developers.google.com/gmail/api/guides/performance#partial
+FIELD_MASKS = {
+    # message ids to fetch, pull_mail_from_query
+    'gmail.messages.list': 'messages/id,nextPageToken',
+    # ids of messages added since a checkpoint, pull_mail_from_history
+    'gmail.history.list': 'history/messagesAdded/message/id,nextPageToken',
+    # checkpoint for incremental runs, get_mailbox_history_id
+    'gmail.profile': 'historyId',
+    # attachment filenames and ids plus the From header, parse_attach_parts
+    # and grab_from_addr_from_payload; format=metadata can't be used here as
+    # it leaves out the parts
+    'gmail.messages.attachment_parts': 'id,'
+                                       'payload(filename,'
+                                       'headers(name,value),'
+                                       'body/attachmentId,'
+                                       'parts(filename,body/attachmentId))',
+    # From header only, grab_from_addr, fetched with format=metadata
+    'gmail.messages.from_header': 'id,payload/headers(name,value)',
+    # attachment content, download_attachs
+    'gmail.attachments.get': 'data,size',
+    # label ids by name, get_label_id
+    'gmail.labels.list': 'labels(id,name)',
+    'gmail.labels.create': 'id,name',
+    # cell values of the look up range, query_sheets_values
+    'sheets.values.get': 'values',
+    # cell values without their formatting, query_sheets
+    'sheets.spreadsheets.get': 'sheets/data/rowData/values/formattedValue',
+    # files to download, list_drive_files and download_files_from_drive
+    # with the size and modifiedTime a partial download is checked against
+    # before it's resumed
+    'drive.files.list': 'nextPageToken,files(id,name,mimeType,size,modifiedTime)',
+    'drive.files.get': 'id,name,mimeType,size,modifiedTime',
+    # revision of the look up sheet, get_sheet_revision
+    'drive.sheet_revision': 'version,modifiedTime',
+    # calendar and event details, calendar funcs
+    'calendar.calendars.get': 'id,summary,timeZone',
+    'calendar.events.list': 'items(id,status,summary,description,location,'
+                            'start,end,updated,htmlLink),'
+                            'nextPageToken,nextSyncToken',
+}
+
+# masks can be turned off to compare against full responses, ie with the cli's
+# --full_responses flag, in which case every field is asked for with *
+FIELD_MASKS_ENABLED = True
+
+def fields_mask(name):
+    # fields= value for the workflow call name, from FIELD_MASKS
+    return FIELD_MASKS[name] if FIELD_MASKS_ENABLED else '*'
+
+# ############################################################################ #
+# ########################## REQUEST EXECUTION ############################### #
+# ############################################################################ #
+# quota units each api method costs against the per user limit, see:
+# https://developers.google.com/gmail/api/reference/quota
+# methods not listed cost 1 unit
+QUOTA_UNITS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.labels.list': 1,
+    'gmail.users.labels.create': 5,
+    'gmail.users.history.list': 2,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.attachments.get': 5,
+    'gmail.users.messages.batchModify': 50,
+    'gmail.users.watch': 100,
+    'gmail.users.stop': 50,
+}
+
+# per user quota for each api as (units per second, burst size); drive and
+# sheets limits are per 100 seconds and per minute, spread evenly here
+QUOTA_RATES = {
+    'gmail': (250, 250),
+    'drive': (10, 100),
+    'sheets': (1, 60),
+    'calendar': (5, 50),
+}
+
+# http statuses, and 403 error reasons, that are worth retrying
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RETRYABLE_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded', 'backendError'}
+
+class TokenBucket(object):
+    # refills at rate units per second up to capacity; acquire blocks until
+    # the requested units are available and returns the seconds it waited
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, units):
+        # a request costing more than the bucket holds waits for a full bucket
+        units = min(float(units), self.capacity)
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= units:
+                    self.tokens -= units
+                    return waited
+                wait = (units - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+class RequestScheduler(object):
+    # single place every api request is executed: paces requests with a token
+    # bucket per api so the per user quota isn't exceeded, and retries rate
+    # limit and server errors with jittered exponential backoff. throttle
+    # time spent waiting on the buckets and on backoff is kept in stats
+    def __init__(self, rates=None, max_retries=5, base_delay=1.0, max_delay=64.0):
+        rates = QUOTA_RATES if rates is None else rates
+        self.buckets = {api: TokenBucket(rate, burst)
+                        for api, (rate, burst) in rates.items()}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats = {'requests': 0,
+                      'retries': 0,
+                      'quota_wait_seconds': 0.0,
+                      'backoff_seconds': 0.0}
+        self.stats_lock = threading.Lock()
+
+    def add_stat(self, key, value):
+        with self.stats_lock:
+            self.stats[key] += value
+
+    def acquire(self, method_id, count=1):
+        # wait for quota for count calls of method_id, ie api.resource.method
+        api = (method_id or '').split('.')[0]
+        bucket = self.buckets.get(api)
+        if bucket is None:
+            return 0.0
+        waited = bucket.acquire(QUOTA_UNITS.get(method_id, 1) * count)
+        self.add_stat('quota_wait_seconds', waited)
+        return waited
+
+    def backoff(self, attempt):
+        # sleep for half the exponential delay plus a random half, so parallel
+        # workers that were throttled together don't retry together
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        time.sleep(delay)
+        self.add_stat('retries', 1)
+        self.add_stat('backoff_seconds', delay)
+        return delay
+
+    def execute(self, request, http=None):
+        # execute a googleapiclient request, or batch request, through quota
+        # pacing and retries; batches are charged for every request they hold
+        from googleapiclient.http import BatchHttpRequest
+        if isinstance(request, BatchHttpRequest):
+            method_ids = [request._requests[r].methodId for r in request._order]
+        else:
+            method_ids = [getattr(request, 'methodId', None)]
+        # batches are timed under batch:<method>, ie batch:gmail.users.messages.get
+        metric_name = method_ids[0]
+        if isinstance(request, BatchHttpRequest):
+            metric_name = 'batch:{}'.format(method_ids[0])
+        started = time.perf_counter() if METRICS.enabled else None
+        for attempt in range(self.max_retries + 1):
+            for method_id in method_ids:
+                self.acquire(method_id)
+            self.add_stat('requests', 1)
+            try:
+                response = request.execute(http=http)
+            except (HttpError, socket.timeout, ConnectionError) as exc:
+                if attempt == self.max_retries or not is_retryable(exc):
+                    if started is not None:
+                        METRICS.record(metric_name,
+                                       time.perf_counter() - started,
+                                       retries=attempt,
+                                       errors=1)
+                    raise
+                print('Retrying {} after error: {}'.format(method_ids[0], exc))
+                self.backoff(attempt)
+            else:
+                if started is not None:
+                    METRICS.record(metric_name,
+                                   time.perf_counter() - started,
+                                   nbytes=response_size(response),
+                                   retries=attempt)
+                return response
+
+def is_retryable(exc):
+    # rate limit, quota and transient server or network errors are retryable,
+    # anything else is a real failure
+    if not isinstance(exc, HttpError):
+        return isinstance(exc, (socket.timeout, ConnectionError))
+    status = exc.resp.status
+    if status in RETRYABLE_STATUSES:
+        return True
+    if status == 403:
+        try:
+            errors = json.loads(exc.content.decode('UTF-8'))['error']['errors']
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return False
+        return any(error.get('reason') in RETRYABLE_REASONS for error in errors)
+    return False
+
+# scheduler shared by every request made in this process
+SCHEDULER = RequestScheduler()
+
+def execute(request, http=None):
+    # execute request through the shared scheduler, see RequestScheduler
+    return SCHEDULER.execute(request, http=http)
+
+# ############################################################################ #
+# ########################### INSTRUMENTATION ################################ #
+# ############################################################################ #
+class StageTimer(object):
+    # context manager timing one pass through a pipeline stage, bytes handled
+    # in the stage can be added while it's open
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.nbytes = 0
+
+    def add_bytes(self, nbytes):
+        self.nbytes += nbytes
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.record(self.name,
+                            time.perf_counter() - self.started,
+                            nbytes=self.nbytes,
+                            errors=1 if exc_type is not None else 0)
+        return False
+
+class NullStage(object):
+    # stand in for StageTimer when metrics are off, so timing costs nothing
+    def add_bytes(self, nbytes):
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NULL_STAGE = NullStage()
+
+class RunMetrics(object):
+    # count, total seconds, bytes, retries and errors for every api method and
+    # pipeline stage in a run; off until enabled, and when off record() and
+    # stage() do nothing
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.data = {}
+
+    def record(self, name, seconds, nbytes=0, retries=0, errors=0):
+        if not self.enabled:
+            return None
+        with self.lock:
+            entry = self.data.setdefault(name, {'count': 0,
+                                                'seconds': 0.0,
+                                                'bytes': 0,
+                                                'retries': 0,
+                                                'errors': 0})
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['bytes'] += nbytes
+            entry['retries'] += retries
+            entry['errors'] += errors
+
+    def stage(self, name):
+        # with METRICS.stage('download'): ...
+        if not self.enabled:
+            return NULL_STAGE
+        return StageTimer(self, name)
+
+    def summary(self):
+        # bytes_per_call shows what each call costs on the wire, ie to check
+        # the savings from FIELD_MASKS against a --full_responses run
+        with self.lock:
+            return {name: dict(entry,
+                               seconds=round(entry['seconds'], 6),
+                               bytes_per_call=entry['bytes'] // max(entry['count'], 1))
+                    for name, entry in sorted(self.data.items())}
+
+    def write_prometheus(self, out_f, prefix='google_api'):
+        # write the metrics in prometheus text format for the node exporter
+        # textfile collector, which needs the file replaced atomically
+        help_text = {'count': 'calls or passes',
+                     'seconds': 'seconds spent',
+                     'bytes': 'bytes handled',
+                     'retries': 'retries after retryable errors',
+                     'errors': 'failed calls or passes'}
+        lines = []
+        summary = self.summary()
+        for field in ('count', 'seconds', 'bytes', 'retries', 'errors'):
+            metric = '{}_{}_total'.format(prefix, field)
+            lines.append('# HELP {} {} per api method or stage'.format(metric,
+                                                                      help_text[field]))
+            lines.append('# TYPE {} counter'.format(metric))
+            for name, entry in summary.items():
+                lines.append('{}{{name="{}"}} {}'.format(metric, name, entry[field]))
+        out_dir = os.path.dirname(os.path.abspath(out_f))
+        fd, tmp_path = tempfile.mkstemp(dir=out_dir, suffix='.part')
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, out_f)
+        return out_f
+
+def response_size(response):
+    # approximate bytes of an api response, only measured when metrics are on
+    if response is None:
+        return 0
+    if isinstance(response, bytes):
+        return len(response)
+    return len(json.dumps(response))
+
+# metrics shared by every call and stage in this process
+METRICS = RunMetrics()
+
+# service objects already built in this process, keyed by service, version and
+# account, so each pair is only built once per run
+SERVICE_REGISTRY = {}
+SERVICE_REGISTRY_LOCK = threading.Lock()
+
+# token files written before tokens were stored per account, keyed by the
+# account that owned them; used to seed that account's token the first time
+# it's loaded. any other account always starts from its own credentials file,
+# never from another account's token
+LEGACY_TOKEN_FILES = {
+    'tradedata': 'td_gmail_token.pickle',
+    'personal': 'pers_drive_token.pickle',
+}
+
 # function to authenticate app with previoulsy built token file or credentials
 # file downloaded for google api console
 # returns service object used to communicate with api
-def authenticate(scopes, basedir, credentials_f, service, serv_vers):
-    # set creds to None to allow unpickled tokens to populate empty var
-    creds = None
-    # check if token.pickle file exists in basedir var passed
-    # if yes, this file is used to authenticate service
-    if service == 'gmail':
-        pickle_f = 'td_gmail_token.pickle'
-    elif service == 'drive' or service == 'sheets' or service == 'calendar':
-        pickle_f = 'pers_drive_token.pickle'
-
-    full_token_path = os.path.join(basedir,pickle_f)
+def authenticate(scopes, basedir, credentials_f, service, serv_vers, cache_dir=None, offline=False, account=None):
+    # tokens are stored per account, the --credentials name passed in CLI;
+    # without one the credentials filename is used as the account name
     full_creds_path = os.path.join(basedir,credentials_f)
-    if os.path.exists(full_token_path):
-        with open(full_token_path, 'rb') as token:
-            creds = pickle.load(token)
-    # if token.pcikle does not exist or if creds is invalid, then use passed
-    # credentials file to create new token.pickle or refresh old token file
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            # use provided credntials file with defined scopes to generate
-            # token file
-            flow = InstalledAppFlow.from_client_secrets_file(full_creds_path,
-                                                             scopes)
-            creds = flow.run_local_server()
-            # create new token.pickle
-            with open(full_token_path, 'wb') as token:
-                pickle.dump(creds,token)
+    if not account:
+        account = os.path.splitext(os.path.basename(credentials_f))[0]
+    registry_key = (str(service), str(serv_vers), account)
+    with SERVICE_REGISTRY_LOCK:
+        if registry_key in SERVICE_REGISTRY:
+            return SERVICE_REGISTRY[registry_key]
+    cred_manager = get_credential_manager(os.path.join(basedir, 'tokens'))
+    legacy_token_f = None
+    if account in LEGACY_TOKEN_FILES:
+        legacy_token_f = os.path.join(basedir, LEGACY_TOKEN_FILES[account])
+    creds = cred_manager.get_credentials(account,
+                                         full_creds_path,
+                                         scopes,
+                                         legacy_token_f=legacy_token_f)
     # create service object to return, based on google service and version
     # provided
-    service = build(str(service), str(serv_vers), credentials=creds)
-    return service
-
-def pull_mail_from_query(build_obj, search_query):
-    results = build_obj.users().messages().list(userId='me',
-                                                labelIds=['INBOX'],
-                                                q=search_query).execute()
-    # return object is dict, inside 'messages' key is a list of message
-    # resources confirm messages were returned based on quesry filtering for
-    # only messages with attachments
+    build_obj = build_service(service,
+                              serv_vers,
+                              creds,
+                              cache_dir=cache_dir,
+                              offline=offline)
+    with SERVICE_REGISTRY_LOCK:
+        return SERVICE_REGISTRY.setdefault(registry_key, build_obj)
+
+# credential managers by token dir, so every service in the process shares the
+# same loaded credentials for an account
+CREDENTIAL_MANAGERS = {}
+CREDENTIAL_MANAGERS_LOCK = threading.Lock()
+
+def get_credential_manager(token_dir):
+    with CREDENTIAL_MANAGERS_LOCK:
+        if token_dir not in CREDENTIAL_MANAGERS:
+            CREDENTIAL_MANAGERS[token_dir] = CredentialManager(token_dir)
+        return CREDENTIAL_MANAGERS[token_dir]
+
+class CredentialManager(object):
+    # loads each account's oauth token once, hands the same credentials object
+    # to every service and thread using that account, and refreshes it before
+    # it expires rather than after a request fails. tokens are pickled per
+    # account in token_dir and written atomically. each refresh is recorded in
+    # refresh_events as a dict of account, time started and seconds taken
+    def __init__(self, token_dir, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self.token_dir = token_dir
+        self.refresh_margin = dt.timedelta(seconds=refresh_margin)
+        self.creds = {}
+        self.refresh_events = []
+        # one lock per account, so a slow refresh or browser flow for one
+        # account doesn't hold up threads using another
+        self.account_locks = {}
+        self.lock = threading.Lock()
+
+    def token_path(self, account):
+        return os.path.join(self.token_dir, '{}.pickle'.format(account))
+
+    def account_lock(self, account):
+        with self.lock:
+            return self.account_locks.setdefault(account, threading.Lock())
+
+    def get_credentials(self, account, credentials_f, scopes, legacy_token_f=None):
+        # return valid credentials for account, loading the token on first use,
+        # refreshing it if it's close to expiry, or running the browser flow
+        # from credentials_f if there's no usable token
+        with self.account_lock(account):
+            creds = self.creds.get(account)
+            if creds is None:
+                creds = self.load_token(account, legacy_token_f)
+            if creds and self.needs_refresh(creds) and creds.refresh_token:
+                self.refresh(account, creds)
+            elif not creds or not creds.valid:
+                # use provided credntials file with defined scopes to
+                # generate token file
+                from google_auth_oauthlib.flow import InstalledAppFlow
+                flow = InstalledAppFlow.from_client_secrets_file(credentials_f,
+                                                                 scopes)
+                creds = flow.run_local_server()
+                self.save_token(account, creds)
+            self.creds[account] = creds
+            return creds
+
+    def refresh_expiring(self):
+        # refresh every loaded account that's within the margin of expiring,
+        # for long running processes to call between units of work
+        with self.lock:
+            accounts = list(self.creds)
+        for account in accounts:
+            with self.account_lock(account):
+                creds = self.creds[account]
+                if self.needs_refresh(creds) and creds.refresh_token:
+                    self.refresh(account, creds)
+
+    def needs_refresh(self, creds):
+        if not creds.valid:
+            return True
+        # expiry is a naive utc datetime, None if the token doesn't expire
+        if creds.expiry is None:
+            return False
+        return creds.expiry - self.refresh_margin <= dt.datetime.utcnow()
+
+    def refresh(self, account, creds):
+        # refresh in place so services already built with creds pick up the
+        # new token, then save it for the next run
+        from google.auth.transport.requests import Request
+        started = time.time()
+        creds.refresh(Request())
+        self.refresh_events.append({'account': account,
+                                    'started': started,
+                                    'seconds': time.time() - started})
+        self.save_token(account, creds)
+
+    def load_token(self, account, legacy_token_f=None):
+        token_f = self.token_path(account)
+        if not os.path.exists(token_f):
+            if not legacy_token_f or not os.path.exists(legacy_token_f):
+                return None
+            token_f = legacy_token_f
+        with open(token_f, 'rb') as token:
+            creds = pickle.load(token)
+        if token_f != self.token_path(account):
+            self.save_token(account, creds)
+        return creds
+
+    def save_token(self, account, creds):
+        if not os.path.exists(self.token_dir):
+            os.makedirs(self.token_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=self.token_dir, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as token:
+                pickle.dump(creds, token)
+            os.replace(tmp_path, self.token_path(account))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+class DiscoveryDocCache(discovery_cache_base.Cache):
+    # file backed cache for the discovery document of one service and version,
+    # handed to build() so a fetched document is saved for the next run
+    def __init__(self, cache_dir, service, serv_vers):
+        self.doc_f = os.path.join(cache_dir, '{}.{}.json'.format(service,
+                                                                 serv_vers))
+
+    def get(self, url):
+        if not os.path.exists(self.doc_f):
+            return None
+        with open(self.doc_f) as f:
+            return f.read()
+
+    def set(self, url, content):
+        if not os.path.exists(os.path.dirname(self.doc_f)):
+            os.makedirs(os.path.dirname(self.doc_f))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.doc_f),
+                                        suffix='.part')
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, self.doc_f)
+
+def build_service(service, serv_vers, creds, cache_dir=None, offline=False):
+    # build the service object from the discovery document cached in
+    # cache_dir when there is one, otherwise fetch the document and cache it.
+    # online, documents older than DISCOVERY_CACHE_MAX_AGE are refetched, but
+    # a stale document is still used if the refetch fails; offline, only
+    # cached documents are used, or the one bundled with the client library
+    # if it has one, and a missing one raises FileNotFoundError
+    # google-api-python-client 2.0 and up builds from its bundled documents
+    # by default and never touches the cache, so fetching is asked for
+    # explicitly to keep the cache filled
+    import inspect
+    import httplib2
+    from googleapiclient.discovery import build, build_from_document
+    if not cache_dir:
+        if offline:
+            raise ValueError('offline discovery needs a cache_dir')
+        return build(str(service), str(serv_vers), credentials=creds)
+    build_kwargs = {}
+    if 'static_discovery' in inspect.signature(build).parameters:
+        build_kwargs['static_discovery'] = False
+    doc_cache = DiscoveryDocCache(cache_dir, service, serv_vers)
+    cached_doc = doc_cache.get(None)
+    if cached_doc is None:
+        if offline:
+            cached_doc = bundled_discovery_doc(service, serv_vers)
+            if cached_doc is None:
+                raise FileNotFoundError('No cached discovery document for {} {} '
+                                        'in {}'.format(service, serv_vers, cache_dir))
+            doc_cache.set(None, cached_doc)
+            return build_from_document(cached_doc, credentials=creds)
+        try:
+            return build(str(service), str(serv_vers), credentials=creds,
+                         cache=doc_cache, **build_kwargs)
+        except (HttpError, httplib2.HttpLib2Error, OSError):
+            # can't fetch it, start the cache from the bundled copy if any
+            cached_doc = bundled_discovery_doc(service, serv_vers)
+            if cached_doc is None:
+                raise
+            doc_cache.set(None, cached_doc)
+            return build_from_document(cached_doc, credentials=creds)
+    doc_age = time.time() - os.path.getmtime(doc_cache.doc_f)
+    if offline or doc_age < DISCOVERY_CACHE_MAX_AGE:
+        return build_from_document(cached_doc, credentials=creds)
+    # stale document, drop it so build() fetches a fresh one through the
+    # cache, putting the stale one back if the network is unavailable
+    os.remove(doc_cache.doc_f)
+    try:
+        return build(str(service), str(serv_vers), credentials=creds,
+                     cache=doc_cache, **build_kwargs)
+    except (HttpError, httplib2.HttpLib2Error, OSError) as exc:
+        print('Could not refresh discovery document for {} {}, using cached '
+              'copy: {}'.format(service, serv_vers, exc))
+        doc_cache.set(None, cached_doc)
+        return build_from_document(cached_doc, credentials=creds)
+
+def bundled_discovery_doc(service, serv_vers):
+    # discovery document shipped with google-api-python-client 2.0 and up, or
+    # None with older versions or a service it doesn't bundle
     try:
-        if not results['messages']:
-            return 'No messages that match query: {}'.format(search_query)
+        from googleapiclient.discovery_cache import get_static_doc
+    except ImportError:
+        return None
+    return get_static_doc(str(service), str(serv_vers))
+
+def pull_mail_from_query(build_obj, search_query, max_results=None):
+    # generator yielding message ids that match the query, following
+    # nextPageToken so nothing past the first page is dropped; pages are only
+    # requested as the caller consumes ids, so listing overlaps with whatever
+    # the caller does with each id and memory stays at one page of ids
+    page_token = None
+    yielded = 0
+    while True:
+        page_size = GMAIL_MAX_LIST_PAGE_SIZE
+        if max_results is not None:
+            page_size = min(page_size, max_results - yielded)
+            if page_size <= 0:
+                return
+        results = execute(build_obj.users().messages().list(userId='me',
+                                                            labelIds=['INBOX'],
+                                                            q=search_query,
+                                                            maxResults=page_size,
+                                                            pageToken=page_token,
+                                                            fields=fields_mask('gmail.messages.list')))
+        # return object is dict, inside 'messages' key is a list of message
+        # resources, key is missing when the page is empty
+        for message in results.get('messages', []):
+            yield message['id']
+            yielded += 1
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return
+
+def get_mailbox_history_id(build_obj):
+    # current historyId of the mailbox, saved as the checkpoint for the next
+    # incremental run; grab it before listing so nothing added mid run is lost
+    profile = execute(build_obj.users().getProfile(userId='me',
+                                                   fields=fields_mask('gmail.profile')))
+    return profile['historyId']
+
+def watch_mailbox(build_obj, topic_name, label_ids=None):
+    # ask gmail to publish inbox changes to a pub/sub topic; has to be renewed
+    # at least every 7 days
+    label_ids = ['INBOX'] if label_ids is None else label_ids
+    return execute(build_obj.users().watch(userId='me',
+                                           body={'topicName': topic_name,
+                                                 'labelIds': label_ids}))
+
+def stop_mailbox_watch(build_obj):
+    return execute(build_obj.users().stop(userId='me'))
+
+def pull_mail_from_history(build_obj, start_history_id, max_results=None):
+    # generator yielding ids of messages added to the inbox since
+    # start_history_id, following every page of history().list(); raises
+    # HttpError with a 404 status when the checkpoint is too old for gmail
+    page_token = None
+    seen = set()
+    while True:
+        results = execute(build_obj.users().history().list(userId='me',
+                                                           startHistoryId=start_history_id,
+                                                           labelId='INBOX',
+                                                           historyTypes=['messageAdded'],
+                                                           pageToken=page_token,
+                                                           fields=fields_mask('gmail.history.list')))
+        for record in results.get('history', []):
+            for added in record.get('messagesAdded', []):
+                mess_id = added['message']['id']
+                if mess_id in seen:
+                    continue
+                seen.add(mess_id)
+                yield mess_id
+                if max_results is not None and len(seen) >= max_results:
+                    return
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return
+
+def pull_mail_since_checkpoint(build_obj, start_history_id, search_query, max_results=None, pending=(), listing=None, since=None):
+    # generator yielding message ids added since the checkpoint, plus the
+    # pending ids a previous run left unprocessed, that still match the search
+    # query; history has no query of its own, so its ids are kept only if
+    # messages.list() returns them for the query too, which also drops any
+    # that have since left the inbox. since is when the checkpoint was taken,
+    # in epoch seconds; with no pending ids to check the listing is bounded to
+    # mail received after it, less HISTORY_QUERY_SLACK, so it's sized by the
+    # new mail rather than the query's whole date window. falls back to the
+    # full search query if there's no checkpoint or it has expired. when
+    # passed, listing['truncated'] is set if max_results stopped the listing
+    # before every id was yielded, so the caller knows not to move the
+    # checkpoint past the rest
+    listing = {} if listing is None else listing
+    listing['truncated'] = False
+    if start_history_id:
+        try:
+            # new mail first, so retrying pending ids can't use up max_results
+            candidates = dict.fromkeys(pull_mail_from_history(build_obj,
+                                                              start_history_id))
+            candidates.update(dict.fromkeys(pending))
+        except HttpError as exc:
+            if exc.resp.status != 404:
+                raise
+            print('History checkpoint {} expired, falling back to query'
+                  ''.format(start_history_id))
         else:
-            return results
-    except KeyError:
-        return 'No messages in Inbox'
+            if not candidates:
+                return
+            # pending ids can be older than the checkpoint, they need the
+            # query's full window
+            if since is not None and not pending:
+                search_query += ' after:{}'.format(int(since - HISTORY_QUERY_SLACK))
+            matching = set(pull_mail_from_query(build_obj, search_query))
+            mess_ids = [mess_id for mess_id in candidates if mess_id in matching]
+            if max_results is not None and len(mess_ids) > max_results:
+                listing['truncated'] = True
+                mess_ids = mess_ids[:max_results]
+            yield from mess_ids
+            return
+    # one id past max_results is listed to tell if the query was cut short
+    mess_ids = pull_mail_from_query(build_obj,
+                                    search_query,
+                                    max_results=None if max_results is None else max_results + 1)
+    for count, mess_id in enumerate(mess_ids):
+        if max_results is not None and count >= max_results:
+            listing['truncated'] = True
+            return
+        yield mess_id
+
+def load_history_checkpoint(checkpoint_f, key):
+    # saved checkpoint for key as a dict of the historyId, when it was saved,
+    # the pending and no_folder message ids left for later runs and the look
+    # up sheet revision the no_folder ids were checked against; history_id is
+    # None if there isn't one yet. older checkpoints, a bare historyId or
+    # without the later keys, load with those keys empty
+    checkpoint = None
+    if os.path.exists(checkpoint_f):
+        with open(checkpoint_f) as f:
+            checkpoint = json.load(f).get(key)
+    if not isinstance(checkpoint, dict):
+        checkpoint = {'history_id': checkpoint}
+    checkpoint.setdefault('pending', [])
+    checkpoint.setdefault('no_folder', [])
+    checkpoint.setdefault('sheet_revision', None)
+    checkpoint.setdefault('saved_at', None)
+    return checkpoint
 
+def save_history_checkpoint(checkpoint_f, key, history_id, pending=(), no_folder=(), sheet_revision=None, saved_at=None):
+    # update the checkpoint for key, written atomically so a crash mid write
+    # can't corrupt other keys' checkpoints, and under a lock file so accounts
+    # running in parallel processes don't drop each other's updates. pending
+    # is the ids of messages whose download or label failed, which the next
+    # run checks again; no_folder is the ids with no folder for their domain,
+    # only worth checking again once sheet_revision, the look up they missed
+    # in, has changed. saved_at is when history_id was taken, epoch seconds
+    with file_lock(checkpoint_f + '.lock'):
+        checkpoints = {}
+        if os.path.exists(checkpoint_f):
+            with open(checkpoint_f) as f:
+                checkpoints = json.load(f)
+        checkpoints[key] = {'history_id': history_id,
+                            'saved_at': saved_at,
+                            'pending': list(dict.fromkeys(pending)),
+                            'no_folder': list(dict.fromkeys(no_folder)),
+                            'sheet_revision': sheet_revision}
+        write_json_atomic(checkpoint_f, checkpoints)
+    return history_id
 
-def pull_attachs_from_query_results(build_obj, results):
-    messages = results['messages']
+@contextlib.contextmanager
+def file_lock(lock_f, timeout=30.0, stale_after=120.0):
+    # cross process lock held by creating lock_f exclusively, works the same
+    # on windows and linux. a lock file older than stale_after seconds was left
+    # by a process that died holding it and is taken over
+    lock_dir = os.path.dirname(os.path.abspath(lock_f))
+    if not os.path.exists(lock_dir):
+        os.makedirs(lock_dir)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            fd = os.open(lock_f, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_f) > stale_after:
+                    os.remove(lock_f)
+                    continue
+            except OSError:
+                # released between the open and the check, try again
+                continue
+            if time.time() > deadline:
+                raise TimeoutError('Timed out waiting for lock {}'.format(lock_f))
+            time.sleep(0.05)
+    os.close(fd)
+    try:
+        yield lock_f
+    finally:
+        os.remove(lock_f)
+
+def write_json_atomic(out_f, obj):
+    # dump obj to a temp file next to out_f then rename it into place, so
+    # readers never see a half written file and a crash leaves the old one
+    out_dir = os.path.dirname(os.path.abspath(out_f))
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, suffix='.part')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f)
+        os.replace(tmp_path, out_f)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return out_f
+
+def pull_attachs_from_query_results(build_obj, mess_ids):
+    # mess_ids is any iterable of message ids, ie pull_mail_from_query()
     # list var to to append message info tuples of
     # (attachmentId, messageId, filename). the script will iterate through this
     # list and call attachment.get() api on each attachmentId
     attach_ids = []
     not_accept_ext_lst = []
-    # iterate through nested message list, wrapping in try block in case
-    # message resource missing 'payload' or 'parts' key
-    # TODO make try bloack/error messsaging more robust
-        # iterate through messages list
-    for message in messages:
+    # iterate through message ids
+    for mess_id in mess_ids:
         # call messages.get() to retrieve details on each message
         # including filename and attachmentId which is necessary to
         # pull actual attachment
-        mess = build_obj.users().messages().get(userId='me',
-                                             id=message['id']).execute()
-        # variabilize messageId and message headers
-        # while in the message object, headers include to, from, subject
-        # information, both are added to info tuple for later processing
-        m_id = mess['id']
+        mess = execute(build_obj.users().messages().get(userId='me',
+                                                        id=mess_id,
+                                                        fields=fields_mask('gmail.messages.attachment_parts')))
         # grab from email addr from message
-        from_addr = grab_from_addr(m_id, build_obj)
-        # NOT CORRECT m_headers = mess['payload']['headers']
-        # iterate through parts in payload dict, if the file extension
-        # for the filename in the message resource is in the accepted
-        # list, append approriate info
+        from_addr = grab_from_addr(mess['id'], build_obj)
+        accepted, not_accepted = parse_attach_parts(mess, from_addr)
+        attach_ids.extend(accepted)
+        not_accept_ext_lst.extend(not_accepted)
+    return attach_ids, not_accept_ext_lst
+
+def batch_pull_attachs_from_query_results(build_obj, mess_ids, batch_size=50):
+    # same output as pull_attachs_from_query_results, but message gets are
+    # grouped into gmail batch http requests and the from addr is taken from
+    # the headers of the same payload, so each message is fetched only once.
+    # mess_ids is consumed lazily, one batch worth at a time, so a generator
+    # from pull_mail_from_query only lists the next page when it's needed.
+    # returns attach ids, not accepted ids and a dict of fetch stats with the
+    # number of messages fetched and http round trips made
+    if not 0 < batch_size <= GMAIL_MAX_BATCH_SIZE:
+        raise ValueError('batch_size must be between 1 and {}'
+                         ''.format(GMAIL_MAX_BATCH_SIZE))
+    attach_ids = []
+    not_accept_ext_lst = []
+    fetch_stats = {'messages': 0, 'round_trips': 0}
+    # batch callbacks fire in any order, responses are collected by request id
+    # and parsed in original message order once the batch returns
+    responses = {}
+    # messages throttled inside a batch come back as errors on their own
+    # callback, they're collected here and sent again in a follow up batch
+    retry_ids = []
+    def collect(request_id, response, exception):
+        # messages listed from history can be deleted before they're fetched
+        if isinstance(exception, HttpError) and exception.resp.status == 404:
+            print('Message {} no longer exists'.format(request_id))
+            return
+        if exception is not None:
+            if is_retryable(exception):
+                retry_ids.append(request_id)
+                return
+            raise exception
+        responses[request_id] = response
+        # the batch itself is timed by execute(), count each message in it
+        if METRICS.enabled:
+            METRICS.record('gmail.users.messages.get', 0.0,
+                           nbytes=response_size(response))
+    mess_ids = iter(mess_ids)
+    while True:
+        chunk = list(itertools.islice(mess_ids, batch_size))
+        if not chunk:
+            break
+        pending = chunk
+        for attempt in range(SCHEDULER.max_retries + 1):
+            batch = build_obj.new_batch_http_request(callback=collect)
+            for mess_id in pending:
+                batch.add(build_obj.users().messages().get(userId='me',
+                                                           id=mess_id,
+                                                           fields=fields_mask('gmail.messages.attachment_parts')),
+                          request_id=mess_id)
+            execute(batch)
+            fetch_stats['round_trips'] += 1
+            if not retry_ids:
+                break
+            if attempt == SCHEDULER.max_retries:
+                raise RuntimeError('Gave up fetching {} throttled messages'
+                                   ''.format(len(retry_ids)))
+            pending = retry_ids[:]
+            del retry_ids[:]
+            SCHEDULER.backoff(attempt)
+        fetch_stats['messages'] += len(chunk)
+        for mess_id in chunk:
+            mess = responses.pop(mess_id, None)
+            if mess is None:
+                continue
+            from_addr = grab_from_addr_from_payload(mess)
+            accepted, not_accepted = parse_attach_parts(mess, from_addr)
+            attach_ids.extend(accepted)
+            not_accept_ext_lst.extend(not_accepted)
+    return attach_ids, not_accept_ext_lst, fetch_stats
+
+def parse_attach_parts(mess, from_addr):
+    # build (attachmentId, messageId, from_addr, filename) tuples for each
+    # attachment in a message resource, split by whether the file extension is
+    # in the accepted list
+    attach_ids = []
+    not_accept_ext_lst = []
+    m_id = mess['id']
+    # iterate through parts in payload dict, if the file extension
+    # for the filename in the message resource is in the accepted
+    # list, append approriate info
+    try:
+        for part in mess['payload']['parts']:
+            if part['filename']:
+                if part['filename'].split('.')[-1].lower() in EXTENSIONS:
+                    attach_ids.append((part['body']['attachmentId'],
+                                        m_id,
+                                        from_addr,
+                                        part['filename'],))
+                else:
+                    not_accept_ext_lst.append((part['body']['attachmentId'],
+                                               m_id,
+                                               from_addr,
+                                               part['filename']))
+    except KeyError:
+        # single part messages carry the attachment on the payload itself
         try:
-            for part in mess['payload']['parts']:
-                if part['filename']:
-                    if part['filename'].split('.')[-1].lower() in EXTENSIONS:
-                        attach_ids.append((part['body']['attachmentId'],
-                                            m_id,
-                                            from_addr,
-                                            part['filename'],))
-                    else:
-                        not_accept_ext_lst.append((part['body']['attachmentId'],
-                                                   m_id,
-                                                   from_addr,
-                                                   part['filename']))
-                        continue
+            payload = mess['payload']
+            if payload['filename']:
+                if payload['filename'].split('.')[-1].lower() in EXTENSIONS:
+                    attach_ids.append((payload['body']['attachmentId'],
+                                        m_id,
+                                        from_addr,
+                                        payload['filename'],))
                 else:
-                    continue
+                    not_accept_ext_lst.append((payload['body']['attachmentId'],
+                                               m_id,
+                                               from_addr,
+                                               payload['filename']))
         except KeyError:
-            try:
-                if mess['payload']['filename']:
-                    if mess['payload']['filename'].split('.')[-1].lower() in EXTENSIONS:
-                        attach_ids.append((mess['payload']['body']['attachmentId'],
-                                            m_id,
-                                            from_addr,
-                                            mess['payload']['filename'],))
-                    else:
-                        not_accept_ext_lst.append((part['body']['attachmentId'],
-                                                   m_id,
-                                                   from_addr,
-                                                   part['filename']))
-                        continue
-                else:
-                    continue
-            except KeyError:
-                print('Message {} has no payload'.format(m_id))
-
+            print('Message {} has no payload'.format(m_id))
     # keyError exception accounts for any of the above keys being missing
     # while still allowing other errors to raise exception
     return attach_ids, not_accept_ext_lst
 
-def prepend_fldr_name(attach_dict, look_up_file):
+def build_look_up_index(look_up_file):
+    # index the nested list of from_addr domain, folder_name, provider_id
+    # returned by query_sheets, as domain -> (folder_name, provider_id, domain)
+    # so each attachment's folder is a single dict lookup instead of a scan of
+    # every row; passing an index back in returns it as is
+    if isinstance(look_up_file, dict):
+        return look_up_file
+    look_up_index = {}
+    for row in look_up_file:
+        # rows missing a folder name can't be matched to anything
+        if len(row) < 2 or not row[0]:
+            continue
+        provider_id = row[2] if len(row) > 2 else ''
+        # first row for a domain wins, same as the old top to bottom scan
+        look_up_index.setdefault(row[0].strip().lower(),
+                                 (row[1], provider_id, row[0]))
+    return look_up_index
+
+def parse_from_domain(from_addr):
+    # full lowercased domain from a from header, ie 'Bob <bob@Mail.Acme.com>'
+    # gives 'mail.acme.com'
+    return from_addr.split('@')[-1].strip().rstrip('>').strip().lower()
+
+def find_look_up(look_up_index, from_addr, suffix_match=False):
+    # return (folder_name, provider_id, domain) for a from addr or domain, or
+    # None if there's no match. the sheet is keyed either by full domain or by
+    # its first label, ie 'acme.com' or 'acme', both are tried exactly; with
+    # suffix_match, parent domains of a subdomain are tried too, so
+    # 'mail.acme.com' falls back to 'acme.com' and 'acme'
+    labels = parse_from_domain(from_addr).split('.')
+    # stop before the bare top level domain, 'com' isn't a provider
+    last = len(labels) - 1 if suffix_match and len(labels) > 1 else 1
+    for i in range(last):
+        for key in ('.'.join(labels[i:]), labels[i]):
+            entry = look_up_index.get(key)
+            if entry is not None:
+                return entry
+    return None
+
+def prepend_fldr_name(attach_dict, look_up_file, suffix_match=False):
     # attach dict is from_addr.mess_id_filename as key with attachId as values
-    # look_up_file is nested list of from_addr, folder_name, provider_id
+    # look_up_file is nested list of from_addr, folder_name, provider_id, or
+    # an index of it from build_look_up_index()
     # goal is to prepend folder name to file name using from addr as key
+    look_up_index = build_look_up_index(look_up_file)
     adjusted_dict = {}
     for k, v in attach_dict.items():
         prefix = k.split('_', maxsplit=1)[0]
         fname = k.split('_', maxsplit=1)[1]
-        for item in look_up_file:
-            if prefix.split('.')[0] in item:
-                adjusted_dict[item[1] + '/' + fname] = v
-            else:
-                continue
+        entry = find_look_up(look_up_index,
+                             prefix.rsplit('.', maxsplit=1)[0],
+                             suffix_match=suffix_match)
+        if entry is not None:
+            adjusted_dict[entry[0] + '/' + fname] = v
     return adjusted_dict
 
-def download_attachs(build_obj, attach_ids_list, attachdir, look_up_file, mkdir=False):
-    # dict that will hold the actual attachments with filename combined with
-    # from addr domain name and message id as the key
-    pre_attach_dict = {}
-    # iterate the info tuples, extract the attachmentId, call attchments.get()
-    # method to pull down the actual attachment, and add to dict, using the
-    # filename as the key and the attachment data as the value
+def download_attachs(build_obj, attach_ids_list, attachdir, look_up_file, mkdir=False, workers=0, suffix_match=False, journal=None, manifest=None, expand_zips=False, remove_zips=False):
+    # look up the folder for each attachment by the from addr domain and key
+    # it as folder/filename, any attachment without a matching folder is
+    # dropped here; look_up_file can be the query_sheets list or an index
+    # with a manifest, every attachment is recorded as soon as it's handled.
+    # with expand_zips, zip attachments are expanded into their folder by
+    # expand_zip_attachment as soon as they're written, on their own threads
+    # so it overlaps the downloads still running; remove_zips deletes an
+    # archive once all of it is expanded
+    look_up_index = build_look_up_index(look_up_file)
+    post_attach_dict = {}
+    entries = {}
+    # attachments sharing a filename in the same folder, ie two messages from
+    # one provider both sending trades.csv, are all saved as
+    # <message id>_<filename>, the name build_json reports them under, so
+    # none of them is dropped or overwritten
+    folder_names = {}
     for a_id in attach_ids_list:
-            from_domain = a_id[2].split('@')[-1].split('.')[0]
-            pre_attach_dict[from_domain+'.'+a_id[1]+'_'+ a_id[3]]=build_obj.users()                \
-                                                                           .messages()             \
-                                                                           .attachments()          \
-                                                                           .get(userId='me',
-                                                                                id=a_id[0],
-                                                                                messageId=a_id[1]) \
-                                                                           .execute()
-    post_attach_dict = prepend_fldr_name(pre_attach_dict,look_up_file)
-    # iterate through the attachs dict, pulling fielname and file data with
-    # items() call
-    for k, v in post_attach_dict.items():
-        # decode the byte code and variabilize as file_data, UTF-8 encoded
-        file_data = base64.urlsafe_b64decode(v['data'].encode('UTF-8'))
-        # create file path, checks to see if path exists, if mkdir param is true
-        # and path doesn't exist, path and parents are created, otherwise
-        # exception is raised
+        entry = find_look_up(look_up_index, a_id[2], suffix_match=suffix_match)
+        if entry is not None:
+            folder_names.setdefault((entry[0], a_id[3]), []).append((a_id, entry))
+        elif manifest is not None:
+            manifest.record_attachment(a_id, 'no_folder')
+    for (folder, filename), matches in folder_names.items():
+        for a_id, entry in matches:
+            k = folder + '/' + filename
+            if len(matches) > 1:
+                k = '{}/{}_{}'.format(folder, a_id[1], filename)
+                # the same filename twice in one message
+                count = 1
+                while k in post_attach_dict:
+                    k = '{}/{}_{}_{}'.format(folder, a_id[1], count, filename)
+                    count += 1
+            post_attach_dict[k] = a_id
+            entries[k] = entry
+    # create file paths, checks to see if path exists, if mkdir param is true
+    # and path doesn't exist, path and parents are created, otherwise
+    # exception is raised; done up front so a bad attachdir fails before any
+    # attachment is pulled down
+    for k in post_attach_dict:
         out_folder_path = os.path.join(attachdir,k)
         if not os.path.exists(os.path.dirname(out_folder_path)):
             if mkdir:
@@ -189,88 +1108,723 @@ def download_attachs(build_obj, attach_ids_list, attachdir, look_up_file, mkdir=
                         raise
             else:
                 raise FileNotFoundError('No folder found at {}'.format(out_folder_path))
-        # open file with filepath as original filename and attachs dir, making
-        # sure to open with 'wb' argument to ensure bytes are translated
-        with open(out_folder_path, 'wb+') as f:
-            # write file_data and save
-            f.write(file_data)
-            f.close()
-    return post_attach_dict
-
-def batch_modify_message_label(build_obj, attach_ids_list, not_found_lst, label='Processing'):
-    # pull down all available labels
-    response = build_obj.users().labels().list(userId='me').execute()
-    # extract only labels list from entire response object
-    labels = response['labels']
-    # extrac label id from label id list, save in var
-    proc_label_id = [val['id'] for val in labels if val['name']==label]
-    # extract just the message ids to iclude as list in batchModify() method
-    mess_ids = [a_id[1] for a_id in attach_ids_list]
-    if not_found_lst:
-        for missing in not_found_lst:
-            mess_ids.remove(missing)
-    # ping api, if successful there is no return response for this
-    batch_modify_body = {'ids': mess_ids,
-                         'addLabelIds': proc_label_id,
-                         'removeLabelIds': ['INBOX','UNREAD']}
-    # wrapping in try clause in case label provided not available, then
-    # catch IndexError and print message
-    if not batch_modify_body['ids']:
-        print('No message IDs to update')
+    # attachments that were written, keyed by folder/filename with the
+    # attachment resource minus its data as the value, with a journal key of
+    # skipped, linked or written when a journal is passed, and any that
+    # failed, keyed the same way with the message id and error as the value;
+    # one bad attachment doesn't stop the rest from downloading
+    attach_dict = {}
+    failed = {}
+    # httplib2 is not thread-safe, so with a worker pool each thread builds
+    # its own authorized http transport on first use and reuses it after
+    local = threading.local()
+    def fetch_and_write(k, a_id):
+        # attachments a previous run already stored are skipped
+        if journal is not None and journal.is_stored(a_id[1], a_id[3]):
+            return {'attachmentId': a_id[0], 'journal': 'skipped'}
+        http = None
+        if workers:
+            http = getattr(local, 'http', None)
+            if http is None:
+                http = local.http = new_authorized_http(build_obj)
+        # call attachments.get() to pull down the actual attachment
+        response = execute(build_obj.users()                                   \
+                                    .messages()                                \
+                                    .attachments()                             \
+                                    .get(userId='me',
+                                         id=a_id[0],
+                                         messageId=a_id[1],
+                                         fields=fields_mask('gmail.attachments.get')),
+                           http=http)
+        # decode straight to disk and drop the encoded data, so only the
+        # attachments currently in flight are held in memory
+        b64_data = response.pop('data')
+        out_path = os.path.join(attachdir,k)
+        if journal is None:
+            write_b64_to_file(b64_data, out_path)
+            return response
+        # hash the content before writing, a file providers resent is
+        # hardlinked to the copy already stored instead of written again
+        sha256 = b64_sha256(b64_data)
+        existing = journal.find_by_hash(sha256)
+        if existing and link_file(existing[0], out_path, signature=existing[1]):
+            response['journal'] = 'linked'
+        else:
+            write_b64_to_file(b64_data, out_path)
+            response['journal'] = 'written'
+        journal.record(a_id[1], a_id[3], a_id[0], out_path, sha256)
+        return response
+    expand_pool = None
+    expansions = {}
+    if expand_zips:
+        expand_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1))
+    # filenames of the attachments going into each folder this run, which
+    # members expanded into the folder mustn't take, even before they're
+    # written
+    folder_attach_names = {}
+    for k in post_attach_dict:
+        folder, filename = k.split('/', 1)
+        folder_attach_names.setdefault(folder, set()).add(filename)
+    def expand(k):
+        a_id = post_attach_dict[k]
+        folder, filename = k.split('/', 1)
+        result = expand_zip_attachment(os.path.join(attachdir,k),
+                                       reserved=folder_attach_names[folder] - {filename})
+        if manifest is not None:
+            for path in result['expanded']:
+                # renamed members are recorded under their name in the zip
+                manifest.record_attachment(a_id[:3] + (result['renamed'].get(path, os.path.basename(path)),),
+                                           'expanded_renamed' if path in result['renamed'] else 'expanded',
+                                           entry=entries[k],
+                                           path=path)
+            for name, error in result['errors'].items():
+                manifest.record_attachment(a_id[:3] + (name,),
+                                           'expand_failed',
+                                           entry=entries[k],
+                                           error=error)
+        if not result['errors']:
+            # marked before the zip is removed, a crash in between leaves
+            # nothing to expand again
+            if journal is not None:
+                journal.mark_expanded(a_id[1], a_id[3])
+            if remove_zips:
+                os.remove(os.path.join(attachdir,k))
+        return result
+    def needs_expanding(k, response):
+        # zips stored by an earlier run are expanded again only if the journal
+        # doesn't have them down as fully expanded, ie that run crashed part
+        # way through or was run without expand_zips, and they're still on
+        # disk
+        if not k.lower().endswith('.zip'):
+            return False
+        if response.get('journal') != 'skipped':
+            return True
+        a_id = post_attach_dict[k]
+        return not journal.is_expanded(a_id[1], a_id[3]) and                   \
+               os.path.exists(os.path.join(attachdir,k))
+    def record(k, response=None, exc=None):
+        if expand_pool is not None and exc is None and                         \
+           needs_expanding(k, response):
+            expansions[k] = expand_pool.submit(expand, k)
+        if manifest is None:
+            return
+        if exc is not None:
+            manifest.record_attachment(post_attach_dict[k], 'failed',
+                                       entry=entries[k], error=str(exc))
+        else:
+            manifest.record_attachment(post_attach_dict[k],
+                                       response.get('journal', 'written'),
+                                       entry=entries[k],
+                                       path=os.path.join(attachdir,k))
+    if workers:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(fetch_and_write, k, a_id): k
+                       for k, a_id in post_attach_dict.items()}
+            for future in concurrent.futures.as_completed(futures):
+                k = futures[future]
+                try:
+                    attach_dict[k] = future.result()
+                except Exception as exc:
+                    print('Failed to download {}: {}'.format(k, exc))
+                    failed[k] = {'message_id': post_attach_dict[k][1],
+                                 'error': str(exc)}
+                    record(k, exc=exc)
+                else:
+                    record(k, response=attach_dict[k])
+    else:
+        for k, a_id in post_attach_dict.items():
+            try:
+                attach_dict[k] = fetch_and_write(k, a_id)
+            except Exception as exc:
+                print('Failed to download {}: {}'.format(k, exc))
+                failed[k] = {'message_id': a_id[1], 'error': str(exc)}
+                record(k, exc=exc)
+            else:
+                record(k, response=attach_dict[k])
+    # expanded members and any member errors are added to the zip's value in
+    # attach_dict; a zip that can't be read at all is reported but its
+    # message still counts as downloaded
+    if expand_pool is not None:
+        for k, future in expansions.items():
+            try:
+                result = future.result()
+            except Exception as exc:
+                print('Failed to expand {}: {}'.format(k, exc))
+                attach_dict[k]['expand_error'] = str(exc)
+                continue
+            attach_dict[k]['expanded'] = result['expanded']
+            if result['renamed']:
+                print('Renamed {} members of {}, their names were already in '
+                      'use'.format(len(result['renamed']), k))
+                attach_dict[k]['expand_renamed'] = result['renamed']
+            if result['errors']:
+                print('Failed to expand {} members of {}'.format(len(result['errors']), k))
+                attach_dict[k]['expand_errors'] = result['errors']
+        expand_pool.shutdown()
+    return attach_dict, failed
+
+def b64_sha256(b64_data, chunk_size=B64_DECODE_CHUNK_SIZE):
+    # sha256 hex digest of the decoded content of urlsafe base64 data, decoded
+    # a chunk at a time the same way write_b64_to_file does
+    chunk_size -= chunk_size % 4
+    digest = hashlib.sha256()
+    for start in range(0, len(b64_data), chunk_size):
+        chunk = b64_data[start:start + chunk_size].encode('UTF-8')
+        chunk += b'=' * (-len(chunk) % 4)
+        digest.update(base64.urlsafe_b64decode(chunk))
+    return digest.hexdigest()
+
+def file_signature(path):
+    # (size, mtime_ns, inode) of a file, or None if it's gone. every write in
+    # this module renames a new file into place, so a path that's been
+    # overwritten since its signature was taken no longer matches it
+    try:
+        stat = os.stat(path)
+    except OSError:
         return None
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+def link_file(src_path, out_path, signature=None):
+    # hardlink src_path to out_path, replacing anything at out_path; returns
+    # False if the link can't be made, ie across filesystems or src is gone.
+    # with a signature, the linked file must still match it, so a src that
+    # was overwritten with other content after it was looked up isn't used
+    if os.path.abspath(src_path) == os.path.abspath(out_path):
+        current = file_signature(out_path)
+        return current is not None and signature in (None, current)
+    tmp_path = os.path.join(os.path.dirname(out_path),
+                            '.{}.{}.link'.format(os.path.basename(out_path),
+                                                 threading.get_ident()))
     try:
-        build_obj.users()                                                      \
-                 .messages()                                                   \
-                 .batchModify(userId='me',body=batch_modify_body)              \
-                 .execute()
-    except (IndexError, HttpError):
+        os.link(src_path, tmp_path)
+    except OSError:
+        return False
+    # checked on the link itself, src could be replaced after it was made
+    if signature is not None and file_signature(tmp_path) != signature:
+        os.remove(tmp_path)
+        return False
+    os.replace(tmp_path, out_path)
+    return True
+
+class AttachmentJournal(object):
+    # sqlite journal of attachments written to disk, keyed by message id and
+    # filename, with the sha256 of each file's content. gmail hands out a new
+    # attachmentId each time a message is fetched, so the id is kept for
+    # reference but isn't part of the key. every record is committed as it's
+    # written, so a crashed run resumes from the last stored attachment.
+    # the size, mtime and inode of each file are kept too, so a path that's
+    # since been overwritten by another attachment of the same name isn't
+    # mistaken for a copy of its old content. zips record when all their
+    # members were expanded, so one a crashed run or a run without
+    # expand_zips stored is expanded when it's next skipped. safe to share
+    # between download threads
+    def __init__(self, db_f):
+        db_dir = os.path.dirname(os.path.abspath(db_f))
+        if not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_f, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS attachments ('
+                              'message_id TEXT NOT NULL, '
+                              'filename TEXT NOT NULL, '
+                              'attachment_id TEXT, '
+                              'path TEXT NOT NULL, '
+                              'sha256 TEXT NOT NULL, '
+                              'size INTEGER NOT NULL, '
+                              'stored_at TEXT NOT NULL, '
+                              'mtime_ns INTEGER, '
+                              'inode INTEGER, '
+                              'expanded_at TEXT, '
+                              'PRIMARY KEY (message_id, filename))')
+            # journals from before the file signature was kept; their rows
+            # can't be verified so they're never linked from. their zips have
+            # no expanded_at either, so they're expanded again, which reuses
+            # any members already on disk
+            columns = [row[1] for row in self.conn.execute('PRAGMA table_info(attachments)')]
+            for column, column_type in (('mtime_ns', 'INTEGER'),
+                                        ('inode', 'INTEGER'),
+                                        ('expanded_at', 'TEXT')):
+                if column not in columns:
+                    self.conn.execute('ALTER TABLE attachments ADD COLUMN '
+                                      '{} {}'.format(column, column_type))
+            self.conn.execute('CREATE INDEX IF NOT EXISTS attachments_sha256 '
+                              'ON attachments (sha256)')
+
+    def is_stored(self, message_id, filename):
+        with self.lock:
+            row = self.conn.execute('SELECT 1 FROM attachments '
+                                    'WHERE message_id = ? AND filename = ?',
+                                    (message_id, filename)).fetchone()
+        return row is not None
+
+    def is_expanded(self, message_id, filename):
+        with self.lock:
+            row = self.conn.execute('SELECT 1 FROM attachments '
+                                    'WHERE message_id = ? AND filename = ? '
+                                    'AND expanded_at IS NOT NULL',
+                                    (message_id, filename)).fetchone()
+        return row is not None
+
+    def mark_expanded(self, message_id, filename):
+        # a zip rewritten by record() is replaced with a new row, so it's
+        # unmarked until it's expanded again
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE attachments SET expanded_at = ? '
+                              'WHERE message_id = ? AND filename = ?',
+                              (dt.datetime.now().isoformat(),
+                               message_id,
+                               filename))
+
+    def find_by_hash(self, sha256):
+        # (path, signature) of a stored file with this content that's still
+        # on disk unchanged since it was recorded; a file that was since
+        # overwritten, ie a provider resent the same filename with new
+        # content, is a miss
+        with self.lock:
+            rows = self.conn.execute('SELECT path, size, mtime_ns, inode '
+                                     'FROM attachments WHERE sha256 = ?',
+                                     (sha256,)).fetchall()
+        for path, size, mtime_ns, inode in rows:
+            if mtime_ns is None or inode is None:
+                continue
+            signature = (size, mtime_ns, inode)
+            if file_signature(path) == signature:
+                return path, signature
+        return None
+
+    def record(self, message_id, filename, attachment_id, path, sha256):
+        size, mtime_ns, inode = file_signature(path)
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO attachments '
+                              '(message_id, filename, attachment_id, path, '
+                              'sha256, size, stored_at, mtime_ns, inode) '
+                              'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              (message_id,
+                               filename,
+                               attachment_id,
+                               os.path.abspath(path),
+                               sha256,
+                               size,
+                               dt.datetime.now().isoformat(),
+                               mtime_ns,
+                               inode))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def write_b64_to_file(b64_data, out_path, chunk_size=B64_DECODE_CHUNK_SIZE):
+    # decode urlsafe base64 data in chunks into a temp file next to out_path,
+    # then rename it into place so a partial file is never left at out_path;
+    # only one decoded chunk is held in memory at a time
+    # chunks must be a multiple of 4 chars to decode independently
+    chunk_size -= chunk_size % 4
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(out_path),
+                                    prefix='.' + os.path.basename(out_path),
+                                    suffix='.part')
+    # decode and write time are only measured when metrics are on
+    timed = METRICS.enabled
+    decode_secs = write_secs = 0.0
+    written = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for start in range(0, len(b64_data), chunk_size):
+                if timed:
+                    decode_start = time.perf_counter()
+                chunk = b64_data[start:start + chunk_size].encode('UTF-8')
+                # gmail can strip trailing padding from the last chunk
+                chunk += b'=' * (-len(chunk) % 4)
+                file_data = base64.urlsafe_b64decode(chunk)
+                if timed:
+                    write_start = time.perf_counter()
+                    decode_secs += write_start - decode_start
+                f.write(file_data)
+                if timed:
+                    write_secs += time.perf_counter() - write_start
+                    written += len(file_data)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    if timed:
+        METRICS.record('b64_decode', decode_secs, nbytes=len(b64_data))
+        METRICS.record('disk_write', write_secs, nbytes=written)
+    return out_path
+
+def expand_zip_attachment(zip_path, out_dir=None, extensions=EXTENSIONS, chunk_size=ZIP_COPY_CHUNK_SIZE, reserved=()):
+    # expand the members of a zip attachment whose extension is in the
+    # accepted list into out_dir, the zip's own folder by default, ie the
+    # provider folder it was routed to. members are streamed to disk a chunk
+    # at a time, only the archive's directory is held in memory, and each is
+    # written to a temp file that's only moved into place under a name
+    # nothing else holds, so partial files are never left and no file is
+    # overwritten. paths inside the archive are flattened to the member's
+    # filename; if that's taken, by an earlier member, a file already in the
+    # folder or a name in reserved, ie attachments still downloading, the
+    # member is renamed by expanded_member_names. a taken name already
+    # holding the same content is reused, so expanding a zip again doesn't
+    # pile up copies. returns the paths written, a dict of renamed paths to
+    # the member's own name, the member names skipped and a dict of member
+    # names that failed, ie encrypted, with their error
+    import zipfile
+    out_dir = out_dir or os.path.dirname(os.path.abspath(zip_path))
+    zip_stem = os.path.splitext(os.path.basename(zip_path))[0]
+    result = {'expanded': [], 'renamed': {}, 'skipped': [], 'errors': {}}
+    started = time.perf_counter() if METRICS.enabled else None
+    written = 0
+    with zipfile.ZipFile(zip_path) as archive:
+        for member in archive.infolist():
+            name = os.path.basename(member.filename)
+            # directories and mac resource forks aren't files to keep
+            if member.is_dir() or not name or                                  \
+               member.filename.startswith('__MACOSX/'):
+                continue
+            if name.split('.')[-1].lower() not in extensions:
+                result['skipped'].append(member.filename)
+                continue
+            fd, tmp_path = tempfile.mkstemp(dir=out_dir, prefix='.' + name,
+                                            suffix='.part')
+            digest = hashlib.sha256()
+            try:
+                with os.fdopen(fd, 'wb') as f, archive.open(member) as src:
+                    for chunk in iter(lambda: src.read(chunk_size), b''):
+                        digest.update(chunk)
+                        f.write(chunk)
+                for candidate in expanded_member_names(member.filename, zip_stem):
+                    if candidate in reserved:
+                        continue
+                    out_path = os.path.join(out_dir, candidate)
+                    if claim_path(tmp_path, out_path):
+                        break
+                    if file_sha256(out_path, chunk_size) == digest.hexdigest():
+                        os.remove(tmp_path)
+                        break
+            except (RuntimeError, zipfile.BadZipFile, OSError, EOFError) as exc:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                result['errors'][member.filename] = str(exc)
+                continue
+            written += member.file_size
+            result['expanded'].append(out_path)
+            if candidate != name:
+                result['renamed'][out_path] = name
+    if started is not None:
+        METRICS.record('zip_expand', time.perf_counter() - started, nbytes=written)
+    return result
+
+def expanded_member_names(member_filename, zip_stem):
+    # names to try, in order, for a zip member expanded into a folder; its
+    # filename, its path in the archive joined with underscores, the zip's
+    # name before it, then numbered, ie report.csv, q1_report.csv,
+    # trades_report.csv, report_1.csv, report_2.csv...
+    name = os.path.basename(member_filename)
+    yield name
+    joined = member_filename.strip('/').replace('/', '_')
+    if joined != name:
+        yield joined
+    yield '{}_{}'.format(zip_stem, name)
+    stem, ext = os.path.splitext(name)
+    for i in itertools.count(1):
+        yield '{}_{}{}'.format(stem, i, ext)
+
+def claim_path(tmp_path, out_path):
+    # move tmp_path to out_path only if nothing is there, atomically so two
+    # threads can't both take the name; returns False, leaving tmp_path, if
+    # out_path already exists. hardlinking fails if the target exists, where
+    # hardlinks aren't supported the name is claimed with an exclusive create
+    try:
+        os.link(tmp_path, out_path)
+    except FileExistsError:
+        return False
+    except OSError:
+        try:
+            os.close(os.open(out_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        os.replace(tmp_path, out_path)
+        return True
+    os.remove(tmp_path)
+    return True
+
+def file_sha256(path, chunk_size=ZIP_COPY_CHUNK_SIZE):
+    # sha256 hex digest of a file on disk, read a chunk at a time
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def new_authorized_http(build_obj):
+    # new http transport carrying the same credentials as the service object,
+    # for use by a single thread; built by build_http like the one build()
+    # makes, so it has the same socket timeout and a stalled connection
+    # raises socket.timeout for execute() to retry rather than hanging
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.http import build_http
+    return AuthorizedHttp(build_obj._http.credentials, http=build_http())
+
+def get_label_id(build_obj, label, cache_f=None, create=True):
+    # id of the label with the given name, read from cache_f when it's been
+    # looked up before, otherwise from the inbox's labels; a missing label is
+    # created when create is true, otherwise None is returned
+    cached = {}
+    if cache_f and os.path.exists(cache_f):
+        with open(cache_f) as f:
+            cached = json.load(f)
+        if label in cached:
+            return cached[label]
+    # pull down all available labels
+    response = execute(build_obj.users().labels().list(userId='me',
+                                                       fields=fields_mask('gmail.labels.list')))
+    label_ids = {val['name']: val['id'] for val in response.get('labels', [])}
+    if label not in label_ids:
+        if not create:
+            return None
+        created = execute(build_obj.users()                                    \
+                                   .labels()                                   \
+                                   .create(userId='me',
+                                           body={'name': label,
+                                                 'labelListVisibility': 'labelShow',
+                                                 'messageListVisibility': 'show'},
+                                           fields=fields_mask('gmail.labels.create')))
+        print('Created {} label'.format(label))
+        label_ids[label] = created['id']
+    if cache_f:
+        cached[label] = label_ids[label]
+        write_json_atomic(cache_f, cached)
+    return label_ids[label]
+
+def batch_modify_message_label(build_obj, attach_ids_list, not_found_lst, label='Processing', label_cache_f=None, create_label=True):
+    # add label to every message in attach_ids_list, except those in
+    # not_found_lst, and take them out of the inbox marked as read. ids are
+    # deduped, a message with several attachments is listed once per
+    # attachment, and sent in batchModify calls of at most
+    # GMAIL_MAX_MODIFY_IDS. a chunk that fails is reported and the rest are
+    # still sent; returns a dict with the number of messages labeled and a
+    # list of failed chunks with their message ids and error
+    report = {'labeled': 0, 'failed_chunks': []}
+    label_id = get_label_id(build_obj, label, cache_f=label_cache_f, create=create_label)
+    # label has to exist in the inbox to be added
+    if label_id is None:
         print('{} label not found in user\'s inbox'.format(label))
-    return None
+        return report
+    # dict keeps the messages in the order they were found
+    excluded = set(not_found_lst or ())
+    mess_ids = [mess_id for mess_id in dict.fromkeys(a_id[1] for a_id in attach_ids_list)
+                if mess_id not in excluded]
+    if not mess_ids:
+        print('No message IDs to update')
+        return report
+    for start in range(0, len(mess_ids), GMAIL_MAX_MODIFY_IDS):
+        chunk = mess_ids[start:start + GMAIL_MAX_MODIFY_IDS]
+        try:
+            modify_messages(build_obj, chunk, label_id)
+        except HttpError as exc:
+            # a cached label id goes stale if the label is deleted, look it
+            # up again, creating it if need be, and retry the chunk once
+            if not label_cache_f or exc.resp.status not in (400, 404):
+                report['failed_chunks'].append({'ids': chunk, 'error': str(exc)})
+                continue
+            if os.path.exists(label_cache_f):
+                os.remove(label_cache_f)
+            label_id = get_label_id(build_obj,
+                                    label,
+                                    cache_f=label_cache_f,
+                                    create=create_label)
+            try:
+                modify_messages(build_obj, chunk, label_id)
+            except HttpError as exc:
+                report['failed_chunks'].append({'ids': chunk, 'error': str(exc)})
+                continue
+        report['labeled'] += len(chunk)
+    for failed_chunk in report['failed_chunks']:
+        print('Failed to label {} messages: {}'.format(len(failed_chunk['ids']),
+                                                       failed_chunk['error']))
+    return report
 
-def download_files_from_drive(service, fname, file_id='', out_dir=''):
-    # check if file_id was passed to func; if not, retrieve file by filename
-    if not file_id:
-        # pull last 10 files chronologically, only provide id and name in
-        # result set
-        # TODO add option to limit # of files with pageSize arg
-        results = service.files()                                              \
-                         .list(fields='nextPageToken, files(id, name)')        \
-                         .execute()
-        # pull file content from metadata
-        files = results.get('files', [])
-        # check if return value was empty, if not iterate through and grab
-        # the file id that matches the fname passed to the fucntion, save
-        if not files:
-            print('No files found.')
-        else:
-            for item in files:
-                if item['name'].lower() == fname.lower():
-                    file_id = item['id']
-                else:
-                    continue
-    # grab the content of the file_id provided, return as plain text
-    # NOTE: other mime type can be provided
-    content = service.files()                                                  \
-                     .export(fileId=file_id, mimeType='text/csv')              \
-                     .execute()
-    # save file in local directory using filename passed
-    # TODO add path to fname for output dir, include this as a param of func
-    save_fname = fname+'.csv'
-    if out_dir:
-        save_fname = os.path.join(out_dir, save_fname)
-    with open(save_fname, 'wb') as f:
-        f.write(content)
-        f.close()
-    return '{} downloaded from drive'.format(save_fname)
+def modify_messages(build_obj, mess_ids, label_id):
+    # ping api, if successful there is no return response for this; rate
+    # limit errors are retried by execute(), anything else is raised
+    batch_modify_body = {'ids': mess_ids,
+                         'addLabelIds': [label_id],
+                         'removeLabelIds': ['INBOX','UNREAD']}
+    return execute(build_obj.users()                                           \
+                            .messages()                                        \
+                            .batchModify(userId='me',body=batch_modify_body))
+
+def list_drive_files(service, name=None, folder_id=None, mime_type=None):
+    # generator yielding metadata for every drive file matching the filters,
+    # filtered server side with a q query and following every page of results
+    query = ['trashed = false']
+    if name:
+        query.append("name = '{}'".format(escape_drive_query(name)))
+    if folder_id:
+        query.append("'{}' in parents".format(escape_drive_query(folder_id)))
+    if mime_type:
+        query.append("mimeType = '{}'".format(escape_drive_query(mime_type)))
+    page_token = None
+    while True:
+        results = execute(service.files()                                      \
+                                 .list(q=' and '.join(query),
+                                       pageSize=DRIVE_LIST_PAGE_SIZE,
+                                       pageToken=page_token,
+                                       fields=fields_mask('drive.files.list')))
+        for item in results.get('files', []):
+            yield item
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return
+
+def escape_drive_query(value):
+    # values in a drive q query are single quoted, with \ and ' escaped
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
+def drive_save_name(file_meta):
+    # filename a drive file is saved as, google native files get the
+    # extension of the type they're exported as
+    save_fname = file_meta['name']
+    if file_meta['mimeType'] in DRIVE_EXPORT_TYPES:
+        ext = DRIVE_EXPORT_TYPES[file_meta['mimeType']][1]
+        if not save_fname.lower().endswith(ext):
+            save_fname += ext
+    return save_fname
+
+def unique_drive_save_names(files):
+    # drive allows several files with the same name in a folder; each of them
+    # is saved with its file id before the extension, ie report_<id>.csv, so
+    # they don't overwrite each other. returns a dict of file id to filename
+    names = {file_meta['id']: drive_save_name(file_meta) for file_meta in files}
+    counts = {}
+    for name in names.values():
+        counts[name] = counts.get(name, 0) + 1
+    for file_id, name in names.items():
+        if counts[name] > 1:
+            stem, ext = os.path.splitext(name)
+            names[file_id] = '{}_{}{}'.format(stem, file_id, ext)
+    return names
+
+def download_drive_file(service, file_meta, out_dir='', http=None, chunk_size=DRIVE_CHUNK_SIZE, save_name=None):
+    # stream one drive file to out_dir in chunks, never holding more than a
+    # chunk in memory; google native files are exported per
+    # DRIVE_EXPORT_TYPES, anything else is downloaded as is. the file is
+    # written to a .part file named by its file id that's renamed to
+    # save_name, drive_save_name by default, when complete. a binary download
+    # left partway by a previous run picks up where it stopped, if the
+    # .part.json saved next to it shows it's the same file at the same size
+    # and modifiedTime; otherwise it starts over
+    # file_meta is a dict with id, name and mimeType, and size and
+    # modifiedTime when drive has them, as from list_drive_files
+    from googleapiclient.http import MediaIoBaseDownload
+    if file_meta['mimeType'].startswith(DRIVE_NATIVE_PREFIX):
+        if file_meta['mimeType'] not in DRIVE_EXPORT_TYPES:
+            raise ValueError('{} is a {} which can\'t be downloaded'
+                             ''.format(file_meta['name'], file_meta['mimeType']))
+        export_type = DRIVE_EXPORT_TYPES[file_meta['mimeType']][0]
+        request = service.files().export_media(fileId=file_meta['id'],
+                                               mimeType=export_type)
+        resumable = False
+    else:
+        request = service.files().get_media(fileId=file_meta['id'])
+        resumable = True
+    if http is not None:
+        request.http = http
+    save_fname = os.path.join(out_dir, save_name or drive_save_name(file_meta))
+    part_fname = os.path.join(out_dir, '.{}.part'.format(file_meta['id']))
+    part_info_f = part_fname + '.json'
+    part_info = {'id': file_meta['id'],
+                 'size': file_meta.get('size'),
+                 'modifiedTime': file_meta.get('modifiedTime')}
+    # exports don't support range requests, so only media downloads resume
+    progress = 0
+    if resumable and os.path.exists(part_fname) and os.path.exists(part_info_f):
+        with open(part_info_f) as f:
+            if json.load(f) == part_info:
+                progress = os.path.getsize(part_fname)
+    # a run that stopped after the last chunk but before the rename left the
+    # whole file, asking for the range past its end would only get a 416
+    size = file_meta.get('size')
+    complete = progress and size is not None and progress == int(size)
+    if not progress:
+        write_json_atomic(part_info_f, part_info)
+    if not complete:
+        with open(part_fname, 'ab' if progress else 'wb') as f:
+            downloader = MediaIoBaseDownload(f, request, chunksize=chunk_size)
+            # MediaIoBaseDownload has no public way to start at an offset
+            downloader._progress = progress
+            done = False
+            while not done:
+                SCHEDULER.acquire(request.methodId)
+                status, done = downloader.next_chunk(num_retries=SCHEDULER.max_retries)
+    os.replace(part_fname, save_fname)
+    os.remove(part_info_f)
+    return save_fname
+
+def download_files_from_drive(service, fname=None, file_id='', out_dir='', folder_id=None, mime_type=None, workers=0):
+    # download a file by id, or every file matching fname, folder_id and
+    # mime_type; with workers, matching files are downloaded concurrently with
+    # an http transport per thread. a file that fails, ie a subfolder, is
+    # reported and skipped. returns the paths of the saved files
+    if file_id:
+        files = [execute(service.files()                                       \
+                                .get(fileId=file_id,
+                                     fields=fields_mask('drive.files.get')))]
+    else:
+        if not (fname or folder_id or mime_type):
+            raise ValueError('Pass a file name, folder id or mime type to '
+                             'search drive for')
+        files = list(list_drive_files(service,
+                                      name=fname,
+                                      folder_id=folder_id,
+                                      mime_type=mime_type))
+    save_names = unique_drive_save_names(files)
+    saved = []
+    if workers:
+        local = threading.local()
+        def download(file_meta):
+            http = getattr(local, 'http', None)
+            if http is None:
+                http = local.http = new_authorized_http(service)
+            return download_drive_file(service,
+                                       file_meta,
+                                       out_dir,
+                                       http=http,
+                                       save_name=save_names[file_meta['id']])
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(download, file_meta): file_meta
+                       for file_meta in files}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    saved.append(future.result())
+                except Exception as exc:
+                    print('Failed to download {}: {}'
+                          ''.format(futures[future]['name'], exc))
+    else:
+        for file_meta in files:
+            try:
+                saved.append(download_drive_file(service,
+                                                 file_meta,
+                                                 out_dir,
+                                                 save_name=save_names[file_meta['id']]))
+            except Exception as exc:
+                print('Failed to download {}: {}'.format(file_meta['name'], exc))
+    if not saved:
+        print('No files found.')
+    for save_fname in saved:
+        print('{} downloaded from drive'.format(save_fname))
+    return saved
 
 def grab_from_addr(mess_ids, build_obj, lst=False):
     from_addr_dict = {}
     if lst:
         for mess_id in mess_ids:
-            mess = build_obj.users()                                           \
-                            .messages()                                        \
-                            .get(userId='me', id=mess_id)                      \
-                            .execute()
+            mess = execute(build_obj.users()                                   \
+                                    .messages()                                \
+                                    .get(userId='me',
+                                         id=mess_id,
+                                         format='metadata',
+                                         metadataHeaders=['From'],
+                                         fields=fields_mask('gmail.messages.from_header')))
             for sect in mess['payload']['headers']:
                 if sect['name'] == 'From':
                     from_addr_dict[mess_id] = sect['value']
@@ -279,38 +1833,104 @@ def grab_from_addr(mess_ids, build_obj, lst=False):
                     from_addr_dict[mess_id] = 'NULL'
         return from_addr_dict
     else:
-        mess = build_obj.users()                                               \
-                        .messages()                                            \
-                        .get(userId='me', id=mess_ids)                         \
-                        .execute()
+        mess = execute(build_obj.users()                                       \
+                                .messages()                                    \
+                                .get(userId='me',
+                                     id=mess_ids,
+                                     format='metadata',
+                                     metadataHeaders=['From'],
+                                     fields=fields_mask('gmail.messages.from_header')))
         for sect in mess['payload']['headers']:
             if sect['name'] == 'From':
                 return sect['value']
             else:
                 continue
 
+def grab_from_addr_from_payload(mess):
+    # pull from addr out of the headers of an already fetched message resource
+    for sect in mess['payload'].get('headers', []):
+        if sect['name'] == 'From':
+            return sect['value']
+    return 'NULL'
+
 def query_sheets(build_obj, sheet_id, ranges):
     # sample ranges = [Sheet1!A1:B35]
-    query_results = build_obj.spreadsheets()                                   \
-                             .get(spreadsheetId=sheet_id,
-                                  ranges=ranges,
-                                  includeGridData=True)                        \
-                             .execute()
+    query_results = execute(build_obj.spreadsheets()                           \
+                                     .get(spreadsheetId=sheet_id,
+                                          ranges=ranges,
+                                          includeGridData=True,
+                                          fields=fields_mask('sheets.spreadsheets.get')))
     response_lst = [[j['formattedValue'] for j in i['values'] if 'formattedValue' in j]
                     for i
                     in query_results['sheets'][0]['data'][0]['rowData']]
 
     return response_lst
 
-def build_json(output_dir, not_accepted_tup='', file_details='', look_up_file='', error_mess=''):
+def query_sheets_values(build_obj, sheet_id, ranges):
+    # same nested list as query_sheets, but from the values only endpoint so
+    # cell formatting isn't downloaded; empty cells are dropped to match the
+    # cells without a formattedValue that query_sheets skips
+    query_results = execute(build_obj.spreadsheets()                           \
+                                     .values()                                 \
+                                     .get(spreadsheetId=sheet_id,
+                                          range=ranges,
+                                          fields=fields_mask('sheets.values.get')))
+    return [[cell for cell in row if cell != '']
+            for row in query_results.get('values', [])]
+
+def get_sheet_revision(drive_obj, sheet_id):
+    # drive version and modifiedTime of the spreadsheet, either changes when
+    # the sheet is edited so together they identify the revision
+    return execute(drive_obj.files()                                           \
+                            .get(fileId=sheet_id,
+                                 fields=fields_mask('drive.sheet_revision')))
+
+def load_sheets_look_up(build_obj, drive_obj, sheet_id, ranges, cache_f, look_up=None):
+    # look up table for sheet_id and ranges, served from cache_f unless the
+    # spreadsheet's drive revision has changed since it was saved, in which
+    # case it's downloaded with query_sheets_values and cache_f is updated.
+    # when passed, look_up['revision'] is set to the sheet, ranges and drive
+    # revision the table was loaded from
+    revision = get_sheet_revision(drive_obj, sheet_id)
+    if look_up is not None:
+        look_up['revision'] = {'sheet_id': sheet_id,
+                               'ranges': ranges,
+                               'revision': revision}
+    if os.path.exists(cache_f):
+        with open(cache_f) as f:
+            cached = json.load(f)
+        if cached.get('sheet_id') == sheet_id and                              \
+           cached.get('ranges') == ranges and                                  \
+           cached.get('revision') == revision:
+            return cached['values']
+    values = query_sheets_values(build_obj, sheet_id, ranges)
+    write_json_atomic(cache_f, {'sheet_id': sheet_id,
+                                'ranges': ranges,
+                                'revision': revision,
+                                'values': values})
+    return values
+
+def build_json(output_dir, not_accepted_tup='', file_details='', look_up_file='', error_mess='', suffix_match=False, account=None, report=None):
     output_dict = {}
     create_date = dt.datetime.now().strftime('%Y%m%d_%H%M%S')
-    out_filename = '{0}_c2b_trade_date_email_output.json'.format(create_date)
+    # the account is in the name so accounts sharing an output dir and run at
+    # the same second don't overwrite each other's report
+    if account:
+        out_filename = '{0}_{1}_c2b_trade_date_email_output.json'.format(create_date,
+                                                                          account)
+    else:
+        out_filename = '{0}_c2b_trade_date_email_output.json'.format(create_date)
     output_dict['create_date'] = create_date
+    # per api method and stage metrics for the run so far, when turned on;
+    # stages after this one are added by finish_json_report, which needs the
+    # report's path, set in report['path'] when a report dict is passed
+    if METRICS.enabled:
+        output_dict['metrics'] = METRICS.summary()
     folder_not_found_lst = []
     if error_mess:
         output_dict['Error Message:'] = error_mess
     else:
+        look_up_index = build_look_up_index(look_up_file)
         if not_accepted_tup:
             output_dict['unverified_ext'] = not_accepted_tup
         output_dict['files_downloaded'] = len(file_details)
@@ -318,45 +1938,578 @@ def build_json(output_dir, not_accepted_tup='', file_details='', look_up_file=''
         file_count = 0
         # details_tup contains, attach id, mess id, from addr, filename in that
         for item in file_details:
-            output_dict['file_details'][file_count] = {
+            file_detail = {
                 'attachment_id': item[0],
                 'message_id': item[1],
                 'from_email_dom': item[2].split('@')[-1].split('.')[0],
                 'filename': item[1] + '_' + item[3]
             }
-            file_count += 1
-        for file_detail in output_dict['file_details'].values():
-            found_match = False
-            for look_up_file_item in look_up_file:
-                if file_detail['from_email_dom'] in look_up_file_item:
-                    file_detail['folder_name'] = look_up_file_item[1]
-                    file_detail['provider_id'] = look_up_file_item[2]
-                    file_detail['email_from_domain'] = look_up_file_item[0]
-                    found_match = True
-                    break
-                else:
-                    continue
-            if not found_match:
+            entry = find_look_up(look_up_index, item[2], suffix_match=suffix_match)
+            if entry is not None:
+                file_detail['folder_name'] = entry[0]
+                file_detail['provider_id'] = entry[1]
+                file_detail['email_from_domain'] = entry[2]
+            else:
                 folder_not_found_lst.append(file_detail['message_id'])
                 file_detail['notes'] = 'no folder name found for domain name {}'\
                                        ' '.format(file_detail['from_email_dom'])
+            output_dict['file_details'][file_count] = file_detail
+            file_count += 1
     output = json.dumps(output_dict)
-    with open(output_dir+out_filename, 'w') as f:
+    with open(os.path.join(output_dir, out_filename), 'w') as f:
         f.write(output)
         f.close()
+    if report is not None:
+        report['path'] = os.path.join(output_dir, out_filename)
     return folder_not_found_lst
 
+def finish_json_report(report_f):
+    # replace the metrics snapshot build_json took with the metrics for the
+    # whole run, once the stages after it, ie labeling, have finished, and
+    # stamp when the run ended
+    if not METRICS.enabled:
+        return report_f
+    with open(report_f) as f:
+        output_dict = json.load(f)
+    output_dict['metrics'] = METRICS.summary()
+    output_dict['end_date'] = dt.datetime.now().strftime('%Y%m%d_%H%M%S')
+    return write_json_atomic(report_f, output_dict)
+
+# ############################################################################ #
+# ############################# RUN MANIFEST ################################# #
+# ############################################################################ #
+class RunManifest(object):
+    # append only jsonl record of a run, a run_start line, one line per
+    # attachment as it's handled and a run_end line with the run's counts.
+    # lines are flushed and fsynced every checkpoint_every records and on
+    # close, so a crash loses at most the records since the last checkpoint;
+    # with a ManifestIndex the same records are added to it at each
+    # checkpoint. run_info, ie account and query, is kept on the run_start
+    # line. safe to share between threads
+    def __init__(self, manifest_f, index=None, checkpoint_every=MANIFEST_CHECKPOINT_EVERY, **run_info):
+        manifest_dir = os.path.dirname(os.path.abspath(manifest_f))
+        if not os.path.exists(manifest_dir):
+            os.makedirs(manifest_dir)
+        self.manifest_f = os.path.abspath(manifest_f)
+        self.index = index
+        self.checkpoint_every = checkpoint_every
+        self.lock = threading.Lock()
+        self.pending = []
+        self.counts = {}
+        started = dt.datetime.now()
+        self.run_id = '{}_{}'.format(started.strftime('%Y%m%d_%H%M%S'), os.getpid())
+        self.f = open(self.manifest_f, 'a')
+        self.write(dict(run_info,
+                        type='run_start',
+                        run_id=self.run_id,
+                        started=started.isoformat()))
+        if self.index is not None:
+            self.index.start_run(self.run_id, started.isoformat(), self.manifest_f, run_info)
+        self.checkpoint()
+
+    def record_attachment(self, a_id, status, entry=None, path=None, error=None):
+        # a_id is an (attachmentId, messageId, from_addr, filename) tuple and
+        # entry the (folder_name, provider_id, domain) look up it matched;
+        # status is written, linked, skipped, failed, no_folder or
+        # not_accepted, or expanded, expanded_renamed and expand_failed for
+        # the members of a zip attachment, with the member's name as the
+        # filename
+        record = {'type': 'attachment',
+                  'run_id': self.run_id,
+                  'recorded_at': dt.datetime.now().isoformat(),
+                  'status': status,
+                  'message_id': a_id[1],
+                  'attachment_id': a_id[0],
+                  'from_addr': a_id[2],
+                  'from_domain': parse_from_domain(a_id[2]),
+                  'filename': a_id[3],
+                  'folder_name': entry[0] if entry else None,
+                  'provider_id': entry[1] if entry else None,
+                  'path': os.path.abspath(path) if path else None}
+        if error is not None:
+            record['error'] = error
+        self.write(record)
+        return record
+
+    def write(self, record):
+        with self.lock:
+            self.f.write(json.dumps(record) + '\n')
+            if record['type'] == 'attachment':
+                self.pending.append(record)
+                self.counts[record['status']] = self.counts.get(record['status'], 0) + 1
+                if len(self.pending) >= self.checkpoint_every:
+                    self.checkpoint_locked()
+
+    def checkpoint(self):
+        with self.lock:
+            self.checkpoint_locked()
+
+    def checkpoint_locked(self):
+        # make everything written so far durable, then index it
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        if self.index is not None and self.pending:
+            self.index.add_files(self.pending)
+        self.pending = []
+
+    def close(self, status='ok', **counts):
+        # counts are added to the attachment counts by status on the run_end
+        # line, ie labeled
+        counts = dict(self.counts, **counts)
+        finished = dt.datetime.now().isoformat()
+        self.write({'type': 'run_end',
+                    'run_id': self.run_id,
+                    'finished': finished,
+                    'status': status,
+                    'counts': counts})
+        with self.lock:
+            self.checkpoint_locked()
+            self.f.close()
+        if self.index is not None:
+            self.index.finish_run(self.run_id, finished, status, counts)
+        return counts
+
+class ManifestIndex(object):
+    # sqlite index of every run's manifest records, to find which run handled
+    # a message, domain, folder or date without reading every manifest file.
+    # several processes can write to it at once, ie parallel accounts
+    def __init__(self, db_f):
+        db_dir = os.path.dirname(os.path.abspath(db_f))
+        if not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_f, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS runs ('
+                              'run_id TEXT PRIMARY KEY, '
+                              'started TEXT NOT NULL, '
+                              'finished TEXT, '
+                              'status TEXT, '
+                              'manifest_f TEXT NOT NULL, '
+                              'info TEXT, '
+                              'counts TEXT)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                              'run_id TEXT NOT NULL, '
+                              'recorded_at TEXT NOT NULL, '
+                              'status TEXT NOT NULL, '
+                              'message_id TEXT NOT NULL, '
+                              'attachment_id TEXT, '
+                              'from_domain TEXT, '
+                              'filename TEXT, '
+                              'folder_name TEXT, '
+                              'provider_id TEXT, '
+                              'path TEXT, '
+                              'error TEXT)')
+            for column in ('message_id', 'from_domain', 'folder_name', 'recorded_at'):
+                self.conn.execute('CREATE INDEX IF NOT EXISTS files_{0} '
+                                  'ON files ({0})'.format(column))
+
+    def start_run(self, run_id, started, manifest_f, info):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO runs (run_id, started, '
+                              'manifest_f, info) VALUES (?, ?, ?, ?)',
+                              (run_id, started, manifest_f, json.dumps(info)))
+
+    def add_files(self, records):
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT INTO files VALUES '
+                                  '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                  [(r['run_id'],
+                                    r['recorded_at'],
+                                    r['status'],
+                                    r['message_id'],
+                                    r['attachment_id'],
+                                    r['from_domain'],
+                                    r['filename'],
+                                    r['folder_name'],
+                                    r['provider_id'],
+                                    r['path'],
+                                    r.get('error')) for r in records])
+
+    def finish_run(self, run_id, finished, status, counts):
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE runs SET finished = ?, status = ?, '
+                              'counts = ? WHERE run_id = ?',
+                              (finished, status, json.dumps(counts), run_id))
+
+    def query(self, message_id=None, domain=None, folder=None, date=None, run_id=None, limit=None):
+        # records matching every filter passed, newest first, each with the
+        # manifest file of its run. domain matches the sender's domain and its
+        # subdomains, date is a day as YYYY-MM-DD
+        where = []
+        params = []
+        if message_id:
+            where.append('f.message_id = ?')
+            params.append(message_id)
+        if domain:
+            domain = domain.lower()
+            where.append("(f.from_domain = ? OR f.from_domain LIKE ? ESCAPE '\\')")
+            params.extend([domain, '%.' + domain.replace('_', '\\_').replace('%', '\\%')])
+        if folder:
+            where.append('f.folder_name = ?')
+            params.append(folder)
+        if date:
+            day = dt.datetime.strptime(date, '%Y-%m-%d')
+            where.append('f.recorded_at >= ? AND f.recorded_at < ?')
+            params.extend([day.isoformat(), (day + dt.timedelta(days=1)).isoformat()])
+        if run_id:
+            where.append('f.run_id = ?')
+            params.append(run_id)
+        sql = 'SELECT f.*, r.manifest_f FROM files f JOIN runs r ON r.run_id = f.run_id'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY f.recorded_at DESC'
+        if limit:
+            sql += ' LIMIT {:d}'.format(limit)
+        with self.lock:
+            cursor = self.conn.execute(sql, params)
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def runs(self, limit=None):
+        # runs newest first, with their status, counts and manifest file
+        sql = 'SELECT * FROM runs ORDER BY started DESC'
+        if limit:
+            sql += ' LIMIT {:d}'.format(limit)
+        with self.lock:
+            cursor = self.conn.execute(sql)
+            columns = [c[0] for c in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        for row in rows:
+            row['info'] = json.loads(row['info'] or '{}')
+            row['counts'] = json.loads(row['counts'] or '{}')
+        return rows
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
 # ############################################################################ #
 # ########################### CALENDAR API FUNCS ############################# #
 # ############################################################################ #
 def get_cal_by_id(build_obj,id):
-    cal = build_obj.calendar().get(calendarId=id).execute()
+    cal = execute(build_obj.calendars().get(calendarId=id,
+                                            fields=fields_mask('calendar.calendars.get')))
     return cal
 
-def get_cal_events_by_date_range(build_obj, cal_id, time_min, time_max):
-    events = build_obj.events().list(calendarId=cal_id, timeMax=time_max, timeMin=time_min).execute()
-    return events
+def list_cal_events(build_obj, cal_id, **params):
+    # generator yielding every event of events().list() for cal_id and params,
+    # following nextPageToken
+    page_token = None
+    while True:
+        results = execute(build_obj.events().list(calendarId=cal_id,
+                                                  maxResults=CALENDAR_LIST_PAGE_SIZE,
+                                                  pageToken=page_token,
+                                                  fields=fields_mask('calendar.events.list'),
+                                                  **params))
+        for event in results.get('items', []):
+            yield event
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return
+
+def sync_calendar_events(build_obj, cal_id, store):
+    # bring the local store up to date with cal_id. the first sync lists every
+    # event, after that only events changed since the saved syncToken are
+    # listed, with deleted ones marked cancelled. gmail style, an expired
+    # token comes back as a 410 and the calendar is resynced in full.
+    # recurring events are expanded into single instances so they can be
+    # queried by time like any other event
+    sync_token = store.sync_token(cal_id)
+    stats = {'calendar': cal_id,
+             'full_sync': sync_token is None,
+             'updated': 0,
+             'deleted': 0,
+             'pages': 0}
+    page_token = None
+    while True:
+        params = {'singleEvents': True}
+        if sync_token:
+            params['syncToken'] = sync_token
+        try:
+            results = execute(build_obj.events().list(calendarId=cal_id,
+                                                      maxResults=CALENDAR_LIST_PAGE_SIZE,
+                                                      pageToken=page_token,
+                                                      fields=fields_mask('calendar.events.list'),
+                                                      **params))
+        except HttpError as exc:
+            if exc.resp.status != 410 or not sync_token:
+                raise
+            print('Sync token for calendar {} expired, resyncing in full'
+                  ''.format(cal_id))
+            store.reset(cal_id)
+            sync_token = page_token = None
+            stats.update(full_sync=True, updated=0, deleted=0)
+            continue
+        updated, deleted = store.apply_events(cal_id, results.get('items', []))
+        stats['updated'] += updated
+        stats['deleted'] += deleted
+        stats['pages'] += 1
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+    # only saved once every page is applied, an interrupted sync starts again
+    # from the previous token and reapplying the same changes is harmless
+    store.save_sync_token(cal_id, results.get('nextSyncToken'))
+    return stats
+
+def sync_calendar_if_stale(build_obj, cal_id, store, max_age=CALENDAR_SYNC_MAX_AGE):
+    # sync cal_id if it hasn't been synced in the last max_age seconds, None
+    # never syncs and 0 always does; returns the sync stats or None
+    if max_age is None:
+        return None
+    synced_at = store.synced_at(cal_id)
+    if synced_at is not None and time.time() - synced_at < max_age:
+        return None
+    return sync_calendar_events(build_obj, cal_id, store)
+
+def get_cal_events_by_date_range(build_obj, cal_id, time_min, time_max, store=None, sync_max_age=CALENDAR_SYNC_MAX_AGE):
+    # events overlapping time_min to time_max, datetimes or rfc3339 strings,
+    # in start order. with a CalendarStore the store is synced if it's stale
+    # and answered locally, otherwise the range is listed from the api
+    if store is None:
+        return list(list_cal_events(build_obj,
+                                    cal_id,
+                                    timeMin=to_rfc3339(time_min),
+                                    timeMax=to_rfc3339(time_max),
+                                    singleEvents=True,
+                                    orderBy='startTime'))
+    sync_calendar_if_stale(build_obj, cal_id, store, max_age=sync_max_age)
+    return store.events_in_range(cal_id, time_min, time_max)
+
+def get_cal_events_by_query(build_obj, cal_id, query, store=None, sync_max_age=CALENDAR_SYNC_MAX_AGE, time_min=None, time_max=None):
+    # events whose summary, description or location contain every word of
+    # query, optionally only those overlapping time_min to time_max. with a
+    # CalendarStore the search runs locally, otherwise it's sent to the api
+    # as q, which also matches attendees and other text fields
+    if store is None:
+        params = {'q': query, 'singleEvents': True}
+        if time_min is not None:
+            params['timeMin'] = to_rfc3339(time_min)
+        if time_max is not None:
+            params['timeMax'] = to_rfc3339(time_max)
+        return list(list_cal_events(build_obj, cal_id, **params))
+    sync_calendar_if_stale(build_obj, cal_id, store, max_age=sync_max_age)
+    return store.search(cal_id, query, time_min=time_min, time_max=time_max)
+
+def to_rfc3339(value):
+    # rfc3339 string for the api from a datetime, naive ones taken as local
+    # time, or a string passed through as is
+    if isinstance(value, dt.datetime):
+        if value.tzinfo is None:
+            value = value.astimezone()
+        return value.isoformat()
+    return value
+
+def to_timestamp(value):
+    # unix timestamp of a datetime, date or rfc3339 string; naive datetimes
+    # and dates are taken as local time
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        value = dt.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if not isinstance(value, dt.datetime):
+        value = dt.datetime.combine(value, dt.time())
+    return value.timestamp()
+
+def event_timestamp(when):
+    # unix timestamp of an event's start or end, all day events only carry a
+    # date so they're placed at local midnight, the same way to_timestamp
+    # takes the dates and naive datetimes range queries are bounded by
+    if 'dateTime' in when:
+        return to_timestamp(when['dateTime'])
+    if 'date' in when:
+        return to_timestamp(dt.datetime.strptime(when['date'], '%Y-%m-%d'))
+    return None
+
+def local_timezone_name():
+    # identifies the local timezone all day events were placed in
+    return json.dumps([time.tzname, time.timezone, time.altzone])
+
+class CalendarStore(object):
+    # sqlite mirror of calendar events, kept current by sync_calendar_events,
+    # with the syncToken for each calendar. events are indexed by their time
+    # interval in an r*tree, so range queries only visit overlapping events;
+    # sqlite builds without the rtree module fall back to a start time index.
+    # all day events are placed in local time, so they're placed again if the
+    # store was last opened in another timezone. safe to share between
+    # threads
+    def __init__(self, db_f):
+        db_dir = os.path.dirname(os.path.abspath(db_f))
+        if not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_f, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS events ('
+                              'calendar_id TEXT NOT NULL, '
+                              'event_id TEXT NOT NULL, '
+                              'summary TEXT, '
+                              'description TEXT, '
+                              'location TEXT, '
+                              'start_ts REAL, '
+                              'end_ts REAL, '
+                              'resource TEXT NOT NULL, '
+                              'PRIMARY KEY (calendar_id, event_id))')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS events_start '
+                              'ON events (calendar_id, start_ts)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS sync_state ('
+                              'calendar_id TEXT PRIMARY KEY, '
+                              'sync_token TEXT, '
+                              'synced_at REAL NOT NULL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS store_meta ('
+                              'key TEXT PRIMARY KEY, '
+                              'value TEXT)')
+            # r*tree keyed by the events rowid, its float32 bounds are rounded
+            # outwards so matches are checked again against the exact times
+            try:
+                self.conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS '
+                                  'event_intervals USING rtree(id, start_ts, end_ts)')
+                self.rtree = True
+            except sqlite3.OperationalError:
+                self.rtree = False
+            row = self.conn.execute('SELECT value FROM store_meta '
+                                    'WHERE key = ?', ('all_day_tz',)).fetchone()
+            if row is None or row[0] != local_timezone_name():
+                self.place_all_day_events()
+
+    def place_all_day_events(self):
+        # set the times of every all day event from its dates in the local
+        # timezone; caller holds the lock and transaction
+        rows = self.conn.execute('SELECT rowid, resource FROM events').fetchall()
+        for rowid, resource in rows:
+            event = json.loads(resource)
+            if 'date' not in event.get('start', {}):
+                continue
+            start_ts = event_timestamp(event['start'])
+            end_ts = event_timestamp(event.get('end', {}))
+            if end_ts is None:
+                end_ts = start_ts
+            self.conn.execute('UPDATE events SET start_ts = ?, end_ts = ? '
+                              'WHERE rowid = ?', (start_ts, end_ts, rowid))
+            if self.rtree:
+                self.conn.execute('UPDATE event_intervals SET start_ts = ?, '
+                                  'end_ts = ? WHERE id = ?',
+                                  (start_ts, end_ts, rowid))
+        self.conn.execute('INSERT OR REPLACE INTO store_meta VALUES (?, ?)',
+                          ('all_day_tz', local_timezone_name()))
+
+    def sync_token(self, cal_id):
+        with self.lock:
+            row = self.conn.execute('SELECT sync_token FROM sync_state '
+                                    'WHERE calendar_id = ?', (cal_id,)).fetchone()
+        return row[0] if row else None
+
+    def synced_at(self, cal_id):
+        with self.lock:
+            row = self.conn.execute('SELECT synced_at FROM sync_state '
+                                    'WHERE calendar_id = ?', (cal_id,)).fetchone()
+        return row[0] if row else None
+
+    def save_sync_token(self, cal_id, sync_token):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)',
+                              (cal_id, sync_token, time.time()))
+
+    def reset(self, cal_id):
+        # drop every event and the sync token of cal_id, before a full resync
+        with self.lock, self.conn:
+            if self.rtree:
+                self.conn.execute('DELETE FROM event_intervals WHERE id IN '
+                                  '(SELECT rowid FROM events WHERE calendar_id = ?)',
+                                  (cal_id,))
+            self.conn.execute('DELETE FROM events WHERE calendar_id = ?', (cal_id,))
+            self.conn.execute('DELETE FROM sync_state WHERE calendar_id = ?', (cal_id,))
+
+    def apply_events(self, cal_id, events):
+        # upsert changed events and delete cancelled ones in one transaction,
+        # returns the number updated and deleted
+        updated = deleted = 0
+        with self.lock, self.conn:
+            for event in events:
+                row = self.conn.execute('SELECT rowid FROM events '
+                                        'WHERE calendar_id = ? AND event_id = ?',
+                                        (cal_id, event['id'])).fetchone()
+                if event.get('status') == 'cancelled':
+                    if row is not None:
+                        self.delete_row(row[0])
+                        deleted += 1
+                    continue
+                start_ts = event_timestamp(event.get('start', {}))
+                end_ts = event_timestamp(event.get('end', {}))
+                if end_ts is None:
+                    end_ts = start_ts
+                values = (event.get('summary'),
+                          event.get('description'),
+                          event.get('location'),
+                          start_ts,
+                          end_ts,
+                          json.dumps(event))
+                # updated in place rather than replaced so the rowid, which
+                # keys the interval index, stays the same
+                if row is None:
+                    rowid = self.conn.execute('INSERT INTO events VALUES '
+                                              '(?, ?, ?, ?, ?, ?, ?, ?)',
+                                              (cal_id, event['id']) + values).lastrowid
+                else:
+                    rowid = row[0]
+                    self.conn.execute('UPDATE events SET summary = ?, '
+                                      'description = ?, location = ?, '
+                                      'start_ts = ?, end_ts = ?, resource = ? '
+                                      'WHERE rowid = ?', values + (rowid,))
+                if self.rtree:
+                    self.conn.execute('DELETE FROM event_intervals WHERE id = ?',
+                                      (rowid,))
+                    if start_ts is not None:
+                        self.conn.execute('INSERT INTO event_intervals VALUES '
+                                          '(?, ?, ?)', (rowid, start_ts, end_ts))
+                updated += 1
+        return updated, deleted
+
+    def delete_row(self, rowid):
+        # caller holds the lock and transaction
+        if self.rtree:
+            self.conn.execute('DELETE FROM event_intervals WHERE id = ?', (rowid,))
+        self.conn.execute('DELETE FROM events WHERE rowid = ?', (rowid,))
+
+    def events_in_range(self, cal_id, time_min, time_max):
+        # events of cal_id overlapping time_min to time_max, in start order
+        return self.search(cal_id, '', time_min=time_min, time_max=time_max)
+
+    def search(self, cal_id, query, time_min=None, time_max=None):
+        # events of cal_id whose summary, description or location contain
+        # every word of query, case insensitive, optionally only those
+        # overlapping time_min to time_max, in start order
+        where = ['e.calendar_id = ?']
+        params = [cal_id]
+        tables = 'events e'
+        if time_min is not None or time_max is not None:
+            min_ts = to_timestamp(time_min) if time_min is not None else float('-inf')
+            max_ts = to_timestamp(time_max) if time_max is not None else float('inf')
+            if self.rtree:
+                tables += ' JOIN event_intervals i ON i.id = e.rowid'
+                where.append('i.start_ts <= ? AND i.end_ts >= ?')
+                params.extend([max_ts, min_ts])
+            # an event overlaps if it starts before the range ends and ends
+            # after it starts, zero length events count at their start
+            where.append('e.start_ts < ? AND (e.end_ts > ? OR e.start_ts >= ?)')
+            params.extend([max_ts, min_ts, min_ts])
+        # like is case insensitive for ascii, wildcards in the words are
+        # escaped so they match literally
+        word_match = ' OR '.join("e.{} LIKE ? ESCAPE '\\'".format(col)
+                                 for col in ('summary', 'description', 'location'))
+        for word in query.split():
+            pattern = '%{}%'.format(word.replace('\\', '\\\\')
+                                        .replace('%', '\\%')
+                                        .replace('_', '\\_'))
+            where.append('({})'.format(word_match))
+            params.extend([pattern] * 3)
+        sql = 'SELECT e.resource FROM {} WHERE {} '                            \
+              'ORDER BY e.start_ts'.format(tables, ' AND '.join(where))
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [json.loads(row[0]) for row in rows]
 
-def get_cal_events_by_query(build_obj, query):
-    events = build_obj.events().list(calendarId=cal_id, q=query).execute()
-    return events
+    def close(self):
+        with self.lock:
+            self.conn.close()